@@ -2,32 +2,51 @@
 ###########################################
 # Darkerego, 2023
 ###########################################
+import concurrent.futures
+import functools
+import itertools
+import os
+import sys
+import time
+
 import web3
+from eth_hash.auto import keccak
 from eth_typing import ChecksumAddress
-from web3 import Web3
-from rlp import encode
 import argparse
+
+from tqdm import tqdm
+
 from utils import init_w3
+from utils.contract_address import CREATE2_PREFIX, create2_address, create_address, create_addresses
+from utils.streaming import bounded_map, read_chunks
 
 
-def compute_contract_address(sender_address: str, nonce: int) -> str:
+def to_address_bytes(address: str) -> bytes:
+    return bytes.fromhex(web3.Web3.to_checksum_address(address)[2:])
+
+
+def to_bytes32(value: str) -> bytes:
     """
-    Compute the address of a contract created by a transaction from sender_address with nonce.
+    :param value: 0x hex string of at most 32 bytes, left padded with zeros
     """
-    # Ensure inputs are in the right format
-    sender_address_bytes = Web3.to_bytes(hexstr=web3.Web3.to_checksum_address(sender_address))
-    nonce_bytes = Web3.to_bytes(nonce)
+    raw = bytes.fromhex(value[2:] if value.startswith(('0x', '0X')) else value)
+    if len(raw) > 32:
+        raise ValueError('Value longer than 32 bytes: %s' % value)
+    return raw.rjust(32, b'\x00')
 
-    # RLP encode the structure containing the sender's address and the sender's nonce
-    rlp_encoded = encode([sender_address_bytes, nonce_bytes])
 
-    # Take the Keccak-256 hash
-    hashed = Web3.keccak(rlp_encoded)
+def compute_contract_address(sender_address: str, nonce: int) -> str:
+    """
+    Compute the address of a contract created by a transaction from sender_address with nonce.
+    """
+    return '0x' + create_address(to_address_bytes(sender_address), nonce).hex()
 
-    # The contract address is the last 20 bytes of this hash
-    contract_address = Web3.to_hex(hashed[-20:])
 
-    return contract_address
+def compute_create2_address(deployer: str, salt: str, init_code_hash: str) -> str:
+    """
+    Compute the address of a contract deployed with CREATE2 by `deployer`.
+    """
+    return '0x' + create2_address(to_address_bytes(deployer), to_bytes32(salt), to_bytes32(init_code_hash)).hex()
 
 
 def get_current_nonce(_w3: web3.Web3, addr: ChecksumAddress) -> int:
@@ -40,10 +59,128 @@ def compute_contract_address_nonce(network: str, addr: ChecksumAddress, nonce_in
     print(f'[+] Contract for account {addr} at nonce {nonce} is : {ret}')
 
 
+def bulk_create(senders: list[str], nonces: range) -> list[tuple[str, int, str]]:
+    """
+    Worker entry point for bulk mode.
+    :return: [(sender, nonce, contract address), ...]
+    """
+    rows = []
+    for sender in senders:
+        for nonce, address in create_addresses(to_address_bytes(sender), nonces):
+            rows.append((sender, nonce, '0x' + address.hex()))
+    return rows
+
+
+def bulk_create_to_file(senders_file: str, nonces: range, output_file: str = None, jobs: int = os.cpu_count()):
+    """
+    Stream the CREATE addresses of every sender in `senders_file` over `nonces` as csv.
+    """
+    out = open(output_file, 'w', buffering=1 << 20) if output_file else sys.stdout
+    worker = functools.partial(bulk_create, nonces=nonces)
+    try:
+        out.write('sender,nonce,contract_address\n')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for rows in bounded_map(executor, worker, read_chunks(senders_file, 256), max_pending=jobs * 4):
+                out.writelines(f'{sender},{nonce},{address}\n' for sender, nonce, address in rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def grind_salts(counters: tuple[int, int], deployer: bytes, init_code_hash: bytes, salt_base: bytes,
+                prefix: str = '', suffix: str = '') -> (int, list[tuple[bytes, bytes]]):
+    """
+    Worker entry point for salt search. Salts are salt_base (24 bytes) followed by a big endian
+    8 byte counter, and every task owns a disjoint counter range.
+    :param counters: (first counter, number of salts)
+    :param prefix: lowercase hex the address must start with
+    :param suffix: lowercase hex the address must end with
+    :return: number of salts hashed, [(salt, address), ...] for every match
+    """
+    start, count = counters
+    head = CREATE2_PREFIX + deployer + salt_base
+    found = []
+    for counter in range(start, start + count):
+        salt_tail = counter.to_bytes(8, 'big')
+        address = keccak(head + salt_tail + init_code_hash)[12:].hex()
+        if address.startswith(prefix) and address.endswith(suffix):
+            found.append((salt_base + salt_tail, address))
+    return count, found
+
+
+def search_salts(deployer: str, init_code_hash: str, prefix: str = '', suffix: str = '', matches: int = 1,
+                 jobs: int = os.cpu_count(), chunk_size: int = 1 << 16, salt_base: bytes = None) -> list[tuple]:
+    """
+    Search CREATE2 salts whose address matches a hex prefix and/or suffix, on `jobs` processes.
+    :return: [(salt hex, address hex), ...]
+    """
+    prefix, suffix = prefix.lower().removeprefix('0x'), suffix.lower()
+    if salt_base is None:
+        salt_base = os.urandom(24)
+    worker = functools.partial(grind_salts, deployer=to_address_bytes(deployer),
+                               init_code_hash=to_bytes32(init_code_hash), salt_base=salt_base,
+                               prefix=prefix, suffix=suffix)
+    counters = ((start, chunk_size) for start in itertools.count(0, chunk_size))
+    results = []
+    progress = tqdm(unit='hash', unit_scale=True)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    start = time.time()
+    try:
+        for hashed, found in bounded_map(executor, worker, counters, max_pending=jobs * 4):
+            progress.update(hashed)
+            for salt, address in found:
+                tqdm.write(f'[+] Salt 0x{salt.hex()} -> 0x{address}')
+                results.append(('0x' + salt.hex(), '0x' + address))
+            if len(results) >= matches:
+                break
+    finally:
+        elapsed = time.time() - start
+        progress.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+    print(f'[+] {progress.n} hashes in {elapsed:.1f}s, {progress.n / max(elapsed, 1e-9):,.0f} hashes/s')
+    return results[:matches]
+
+
 if __name__ == '__main__':
     args = argparse.ArgumentParser()
-    args.add_argument('address', type=str, default=None)
+    args.add_argument('address', type=str, nargs='?', default=None, help='Sender, or the deployer in CREATE2 mode.')
     args.add_argument('-i', '--increment', type=int, default=0)
     args.add_argument('-n', '--network', type=str, default='goerli')
+    args.add_argument('-N', '--nonce', type=int, default=None,
+                      help='Use this nonce instead of reading the current one over RPC.')
+    bulk = args.add_argument_group('bulk CREATE mode')
+    bulk.add_argument('-s', '--senders', type=str, default=None, help='File with one sender address per line.')
+    bulk.add_argument('--nonce-start', dest='nonce_start', type=int, default=0)
+    bulk.add_argument('--nonce-count', dest='nonce_count', type=int, default=1)
+    bulk.add_argument('-o', '--output', type=str, default=None, help='Csv output file, default stdout.')
+    create2 = args.add_argument_group('CREATE2 mode')
+    create2.add_argument('-2', '--create2', action='store_true')
+    create2.add_argument('--salt', type=str, default=None, help='32 byte salt.')
+    create2.add_argument('--init-code-hash', dest='init_code_hash', type=str, default=None,
+                         help='keccak256 of the contract init code.')
+    create2.add_argument('-p', '--prefix', type=str, default='', help='Search salts for addresses with this prefix.')
+    create2.add_argument('-S', '--suffix', type=str, default='', help='Search salts for addresses with this suffix.')
+    create2.add_argument('-m', '--matches', type=int, default=1, help='Stop after this many salts are found.')
+    args.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes for bulk and search.')
     args = args.parse_args()
-    compute_contract_address_nonce(args.network, web3.Web3.to_checksum_address(args.address), args.increment)
+
+    if args.senders:
+        bulk_create_to_file(args.senders, range(args.nonce_start, args.nonce_start + args.nonce_count), args.output,
+                            args.jobs)
+    elif args.address is None:
+        print('[!] Supply an address, or a senders file with -s')
+    elif args.create2:
+        if args.init_code_hash is None:
+            print('[!] CREATE2 needs --init-code-hash')
+        elif args.salt is not None:
+            print(f'[+] CREATE2 contract for deployer {args.address} with salt {args.salt} is : '
+                  f'{compute_create2_address(args.address, args.salt, args.init_code_hash)}')
+        elif args.prefix or args.suffix:
+            search_salts(args.address, args.init_code_hash, args.prefix, args.suffix, args.matches, args.jobs)
+        else:
+            print('[!] CREATE2 needs either --salt, or --prefix/--suffix to search for one')
+    elif args.nonce is not None:
+        addr = web3.Web3.to_checksum_address(args.address)
+        print(f'[+] Contract for account {addr} at nonce {args.nonce} is : {compute_contract_address(addr, args.nonce)}')
+    else:
+        compute_contract_address_nonce(args.network, web3.Web3.to_checksum_address(args.address), args.increment)
@@ -1,2 +1,17 @@
 class DotenvNotConfigured(Exception):
     pass
+
+
+class IndexerError(Exception):
+    pass
+
+
+class JsonRpcError(Exception):
+    def __init__(self, message: str, code: int = None, data=None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+class PriceUnavailable(Exception):
+    pass
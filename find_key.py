@@ -1,99 +1,195 @@
 #!/usr/bin/env python3.10
 
 import json
-import math
 
-import web3
 import argparse
-from binascii import Error
 import os
 
-from eth_account.signers.local import LocalAccount
 from eth_typing import ChecksumAddress
 from eth_utils import to_checksum_address
 import concurrent.futures
 
 from tqdm import tqdm
 
+from libs import secp256k1
+from utils.address_index import AddressIndex
+from utils.streaming import bounded_map, read_chunks
+
 
 class Acct:
-    def __init__(self, key: str, address: ChecksumAddress):
+    def __init__(self, key: bytes, address: ChecksumAddress):
         self.key = key
         self.address = address
 
 
-class KeyFinder:
-    def __init__(self, output_file: str):
-        self.output_file = output_file
-        self.found_keys = []
-        # self.addresses = addresses
-
-    def log_result(self, acct: LocalAccount):
-        if args.output:
-            with open(self.output_file, 'a') as f:
-                obj = {"address": acct.address, "key": str(acct.key.hex())}
-                f.write(json.dumps(obj))
-
-    def divide_chunks(self, l: list, n: int) -> list:
-        def div(l, n):
-            for i in range(0, len(l), n):
-                yield l[i:i + n]
-
-        gen = div(l, n)
-        return [x for x in gen]
-
-    def search(self, key):
+def parse_private_key(key: str) -> bytes:
+    """
+    :param key: hex private key, with or without 0x
+    :return: 32 byte key
+    :raises ValueError: if this is not a valid private key
+    """
+    if key.startswith(('0x', '0X')):
+        key = key[2:]
+    private_key = bytes.fromhex(key)
+    secp256k1.check_private_key(private_key)
+    return private_key
+
+
+targets: (set[bytes], AddressIndex) = set()
+
+
+def init_worker(target_addresses: (set[bytes], AddressIndex)):
+    """
+    Process pool initializer, receives the raw 20 byte target addresses once per worker. An
+    AddressIndex only pickles its path, so every worker maps the same file instead of copying it.
+    """
+    global targets
+    targets = target_addresses
+
+
+def split_range(start: int, count: int, size: int):
+    """
+    Split [start, start + count) into disjoint (start, count) sub ranges of at most `size` keys.
+    """
+    for offset in range(0, count, size):
+        yield start + offset, min(size, count - offset)
+
+
+def search_keys(keys: list[str]) -> (int, list[tuple[bytes, bytes]]):
+    """
+    Worker entry point for file mode.
+    :param keys: chunk of hex private keys, invalid lines are skipped
+    :return: number of lines checked, [(key, address), ...] for every match
+    """
+    found = []
+    to_address = secp256k1.privkey_to_address
+    for key in keys:
         try:
-            acct = from_key(key)
-        except (Error, ValueError):
-            pass
+            private_key = parse_private_key(key)
+        except ValueError:
+            continue
+        address = to_address(private_key)
+        if address in targets:
+            found.append((private_key, address))
+    return len(keys), found
+
+
+def search_range(sub_range: tuple[int, int]) -> (int, list[tuple[bytes, bytes]]):
+    """
+    Worker entry point for range mode.
+    :param sub_range: (first key, number of keys)
+    :return: number of keys checked, [(key, address), ...] for every match
+    """
+    start, count = sub_range
+    return count, [(k.to_bytes(32, 'big'), address) for k, address in secp256k1.range_addresses(start, count)
+                   if address in targets]
+
+
+def load_addresses(address: (str, None), addresses_file: (str, None)) -> set[bytes]:
+    """
+    :return: set of raw 20 byte target addresses
+    """
+    target_addresses = set()
+    if address:
+        target_addresses.add(bytes.fromhex(to_checksum_address(address)[2:]))
+    if addresses_file:
+        with open(addresses_file, 'r') as f:
+            for line in f:
+                line = line.strip('\r\n')
+                if line:
+                    target_addresses.add(bytes.fromhex(to_checksum_address(line)[2:]))
+    return target_addresses
 
-        else:
-            # print(acct.address)
-            # with open(args.output, 'w') as f:
-            #    f.write(acct.address+'\n')
-            if addresses.__contains__(to_checksum_address(acct.address)):
-                self.found_keys.append((acct.address, acct.key))
-                print('Found key: ', key)
-                self.log_result(acct)
 
-    def search_batch(self, batch: list):
-        [self.search(key) for key in batch]
+class KeyFinder:
+    def __init__(self, output_file: (str, None), threads: int = os.cpu_count()):
+        """
+        Streaming key search. Work is read lazily and handed to a process pool with a bounded
+        number of tasks in flight, matches come back to this process, which is the only writer.
+        :param output_file: where to log matches as json lines, or None
+        :param threads: worker processes
+        """
+        self.output_file = output_file
+        self.threads = threads
+        self.found_keys: dict[ChecksumAddress, bytes] = {}
+        self._fh = None
+
+    def log_result(self, acct: Acct):
+        if self.output_file:
+            if self._fh is None:
+                self._fh = open(self.output_file, 'a')
+            obj = {"address": acct.address, "key": "0x" + acct.key.hex()}
+            self._fh.write(json.dumps(obj) + '\n')
+            self._fh.flush()
+
+    def report(self, private_key: bytes, address: bytes):
+        acct = Acct(private_key, to_checksum_address(address))
+        if acct.address in self.found_keys:
+            return
+        self.found_keys[acct.address] = acct.key
+        tqdm.write(f'Found key: 0x{acct.key.hex()} for {acct.address}')
+        self.log_result(acct)
+
+    def run(self, worker, work, target_addresses: (set[bytes], AddressIndex), total: int = None):
+        """
+        :param worker: search_keys or search_range
+        :param work: iterable of worker arguments
+        :param target_addresses: raw 20 byte addresses to look for, as a set or an AddressIndex
+        :param total: expected number of keys, for the progress bar
+        """
+        progress = tqdm(total=total, unit='key', unit_scale=True)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.threads, initializer=init_worker,
+                                                        initargs=(target_addresses,)) as executor:
+                for checked, found in bounded_map(executor, worker, work, max_pending=self.threads * 4):
+                    for private_key, address in found:
+                        self.report(private_key, address)
+                    progress.update(checked)
+        finally:
+            progress.close()
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def search_file(self, file: str, target_addresses: (set[bytes], AddressIndex), chunk_size: int = 4096):
+        self.run(search_keys, read_chunks(file, chunk_size), target_addresses)
+
+    def search_range(self, start: int, count: int, target_addresses: (set[bytes], AddressIndex),
+                     chunk_size: int = 1 << 16):
+        self.run(search_range, split_range(start, count, chunk_size), target_addresses, total=count)
 
 
 if __name__ == '__main__':
     args = argparse.ArgumentParser()
-    args.add_argument('-f', '--input', type=str, required=True)
-    args.add_argument('-o', '--output', type=str, required=False, default=False)
+    args.add_argument('-f', '--input', type=str, required=False, default=None)
+    args.add_argument('-o', '--output', type=str, required=False, default=None)
     args.add_argument('-a', '--addresses', type=str, required=False, default=None)
     args.add_argument('-A', '--address', type=str, default=None)
+    args.add_argument('-i', '--index', type=str, default=None,
+                      help='Address index built with `python -m utils.address_index build`, '
+                           'for target sets too large for -a.')
     args.add_argument('-t', '--threads', type=int, default=os.cpu_count())
+    args.add_argument('-s', '--start', type=lambda x: int(x, 0), default=None,
+                      help='Range mode: first private key to scan (int or 0x hex) instead of an input file.')
+    args.add_argument('-c', '--count', type=int, default=1_000_000, help='Range mode: number of keys to scan.')
+    args.add_argument('-r', '--range-chunk', dest='range_chunk', type=int, default=1 << 16,
+                      help='Range mode: keys per worker task.')
+    args.add_argument('-C', '--chunk-size', dest='chunk_size', type=int, default=4096,
+                      help='File mode: keys per worker task.')
     args = args.parse_args()
-    keys = []
-    addresses = []
-    result = []
-    with open(args.input, 'r') as f:
-        f = f.readlines()
-        for line in f:
-            line = line.strip('\r\n')
-            if line is not None:
-                keys.append(line)
-    if args.address:
-        addresses.append(to_checksum_address(args.address))
-    if args.addresses:
-        with open(args.addresses, 'r') as f:
-            f = f.readlines()
-            for line in f:
-                line = line.strip('\r\n')
-                if line:
-                    addresses.append(to_checksum_address(line))
-
-    from_key = web3.Account.from_key
-    kf = KeyFinder(args.output)
-    # map(search, keys)
-    batch_size = int(len(keys) / int(math.ceil(args.threads)) + 1)
-    batches = kf.divide_chunks(keys, batch_size)
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.threads)
-    for x, batch in enumerate(tqdm(batches)):
-        print(f'starting batch {x + 1}/{len(batches)}')
-        executor.submit(kf.search_batch, batch)
+    if args.input is None and args.start is None:
+        print('[!] Supply either an input file of keys (-f) or a key range (-s/-c).')
+        exit(1)
+
+    kf = KeyFinder(args.output, args.threads)
+    if args.index:
+        if args.address or args.addresses:
+            print('[!] Using the address index, ignoring -a/-A')
+        addresses = AddressIndex(args.index)
+    else:
+        addresses = load_addresses(args.address, args.addresses)
+    if args.start is not None:
+        kf.search_range(args.start, args.count, addresses, args.range_chunk)
+    else:
+        kf.search_file(args.input, addresses, args.chunk_size)
+    print(f'[+] Found {len(kf.found_keys)} keys')
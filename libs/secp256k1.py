@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+secp256k1 helpers shared by the key tools: private key -> compressed public key, and
+private key -> 20 byte ethereum address. Uses coincurve (libsecp256k1) when it is
+installed, otherwise a pure python fixed-base window table over the generator.
+
+Benchmark the available backends with: python -m libs.secp256k1
+"""
+import argparse
+import os
+import time
+
+from eth_hash.auto import keccak
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+# curve parameters
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+INFINITY = (1, 1, 0)
+WINDOW_BITS = 8
+
+
+def check_private_key(private_key: bytes) -> int:
+    """
+    :param private_key: 32 byte big endian secret
+    :return: the secret as an int
+    :raises ValueError: if the key is not a valid secp256k1 secret
+    """
+    if len(private_key) != 32:
+        raise ValueError('Private key must be 32 bytes, got %s' % len(private_key))
+    k = int.from_bytes(private_key, 'big')
+    if not 0 < k < N:
+        raise ValueError('Private key is out of range')
+    return k
+
+
+def jacobian_double(p: tuple) -> tuple:
+    x1, y1, z1 = p
+    if not y1 or not z1:
+        return INFINITY
+    yy = y1 * y1 % P
+    s = 4 * x1 * yy % P
+    m = 3 * x1 * x1 % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    z3 = 2 * y1 * z1 % P
+    return x3, y3, z3
+
+
+def jacobian_add_affine(p: tuple, q: tuple) -> tuple:
+    """
+    Mixed addition of a jacobian point p and an affine point q.
+    """
+    x1, y1, z1 = p
+    if not z1:
+        return q[0], q[1], 1
+    x2, y2 = q
+    z1z1 = z1 * z1 % P
+    u2 = x2 * z1z1 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - x1) % P
+    r = (s2 - y1) % P
+    if not h:
+        if not r:
+            return jacobian_double(p)
+        return INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - y1 * hhh) % P
+    z3 = z1 * h % P
+    return x3, y3, z3
+
+
+def to_affine(p: tuple) -> tuple:
+    x, y, z = p
+    z_inv = pow(z, -1, P)
+    z_inv2 = z_inv * z_inv % P
+    return x * z_inv2 % P, y * z_inv2 * z_inv % P
+
+
+def batch_to_affine(points: list[tuple]) -> list[tuple]:
+    """
+    Normalize many jacobian points (none of them at infinity) with a single field
+    inversion, using Montgomery's batch inversion trick.
+    """
+    prefix = []
+    acc = 1
+    for p in points:
+        prefix.append(acc)
+        acc = acc * p[2] % P
+    inv = pow(acc, -1, P)
+    out = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        x, y, z = points[i]
+        z_inv = inv * prefix[i] % P
+        inv = inv * z % P
+        z_inv2 = z_inv * z_inv % P
+        out[i] = (x * z_inv2 % P, y * z_inv2 * z_inv % P)
+    return out
+
+
+def compress(point: tuple) -> bytes:
+    x, y = point
+    return (2 + (y & 1)).to_bytes(1, 'big') + x.to_bytes(32, 'big')
+
+
+def point_to_address(point: tuple) -> bytes:
+    x, y = point
+    return keccak(x.to_bytes(32, 'big') + y.to_bytes(32, 'big'))[12:]
+
+
+class PurePythonBackend:
+    name = 'python'
+
+    def __init__(self):
+        """
+        Fixed-base comb over the generator: table[i][d - 1] holds d * 2^(8i) * G in affine
+        coordinates, so a scalar multiplication is at most 32 mixed additions and one
+        inversion, with no doublings. The table is built on first use.
+        """
+        self._table: (list, None) = None
+
+    @property
+    def table(self) -> list[list[tuple]]:
+        if self._table is None:
+            table = []
+            base = G
+            for _ in range(256 // WINDOW_BITS):
+                row = [(base[0], base[1], 1)]
+                for _ in range((1 << WINDOW_BITS) - 2):
+                    row.append(jacobian_add_affine(row[-1], base))
+                row = batch_to_affine(row)
+                table.append(row)
+                # next window base: 2^WINDOW_BITS * base = (2^WINDOW_BITS - 1) * base + base
+                base = to_affine(jacobian_add_affine((row[-1][0], row[-1][1], 1), base))
+            self._table = table
+        return self._table
+
+    def public_point_jacobian(self, k: int) -> tuple:
+        table = self.table
+        acc = INFINITY
+        i = 0
+        while k:
+            d = k & 0xff
+            if d:
+                acc = jacobian_add_affine(acc, table[i][d - 1])
+            k >>= WINDOW_BITS
+            i += 1
+        return acc
+
+    def public_point(self, private_key: bytes) -> tuple:
+        return to_affine(self.public_point_jacobian(check_private_key(private_key)))
+
+    def pubkey(self, private_key: bytes) -> bytes:
+        return compress(self.public_point(private_key))
+
+    def address(self, private_key: bytes) -> bytes:
+        return point_to_address(self.public_point(private_key))
+
+
+class CoincurveBackend:
+    name = 'coincurve'
+
+    def public_point(self, private_key: bytes) -> tuple:
+        check_private_key(private_key)
+        raw = coincurve.PublicKey.from_valid_secret(private_key).format(compressed=False)
+        return int.from_bytes(raw[1:33], 'big'), int.from_bytes(raw[33:], 'big')
+
+    def pubkey(self, private_key: bytes) -> bytes:
+        check_private_key(private_key)
+        return coincurve.PublicKey.from_valid_secret(private_key).format()
+
+    def address(self, private_key: bytes) -> bytes:
+        check_private_key(private_key)
+        return keccak(coincurve.PublicKey.from_valid_secret(private_key).format(compressed=False)[1:])[12:]
+
+
+backends = {PurePythonBackend.name: PurePythonBackend}
+if coincurve is not None:
+    backends[CoincurveBackend.name] = CoincurveBackend
+
+_backend = None
+
+
+def get_backend(name: str = None):
+    """
+    :param name: backend name, None picks the fastest available one
+    :return: backend instance
+    """
+    global _backend
+    if name is None:
+        if _backend is None:
+            _backend = backends.get(CoincurveBackend.name, PurePythonBackend)()
+        return _backend
+    if name not in backends:
+        raise ValueError('Unknown or unavailable secp256k1 backend: %s' % name)
+    return backends[name]()
+
+
+def set_backend(name: str):
+    global _backend
+    _backend = get_backend(name)
+
+
+def privkey_to_pubkey(private_key: bytes) -> bytes:
+    """
+    :param private_key: 32 byte secret
+    :return: 33 byte compressed public key
+    """
+    return get_backend().pubkey(private_key)
+
+
+def privkey_to_address(private_key: bytes) -> bytes:
+    """
+    :param private_key: 32 byte secret
+    :return: 20 byte address (not checksummed)
+    """
+    return get_backend().address(private_key)
+
+
+def range_addresses(start: int, count: int, batch_size: int = 1024):
+    """
+    Walk the consecutive private keys start .. start + count - 1. The first public key costs one
+    scalar multiplication, every following key one mixed point addition (P + G). Each batch of
+    jacobian points is normalized to affine with a single inversion.
+    :param start: first private key, as an int
+    :param count: number of keys
+    :param batch_size: points per batch inversion
+    :return: generator of (private key int, 20 byte address)
+    """
+    if start < 1 or start + count > N:
+        raise ValueError('Key range must lie within [1, n - 1]')
+    if count <= 0:
+        return
+    x, y = get_backend().public_point(start.to_bytes(32, 'big'))
+    point = (x, y, 1)
+    k = start
+    remaining = count
+    while remaining:
+        n = min(batch_size, remaining)
+        batch = [point]
+        for _ in range(n - 1):
+            batch.append(jacobian_add_affine(batch[-1], G))
+        remaining -= n
+        if remaining:
+            point = jacobian_add_affine(batch[-1], G)
+        for i, affine in enumerate(batch_to_affine(batch)):
+            yield k + i, point_to_address(affine)
+        k += n
+
+
+def benchmark(count: int = 20000):
+    keys = [os.urandom(32) for _ in range(count)]
+    for name in backends:
+        backend = get_backend(name)
+        backend.address(keys[0])  # builds lookup tables, if any
+        start = time.perf_counter()
+        for key in keys:
+            backend.address(key)
+        elapsed = time.perf_counter() - start
+        print(f'[+] {name:>10}: {count / elapsed:,.0f} keys/s')
+    start = int.from_bytes(keys[0], 'big') % (N - count) + 1
+    begin = time.perf_counter()
+    for _ in range_addresses(start, count):
+        pass
+    elapsed = time.perf_counter() - begin
+    print(f'[+] {"range":>10}: {count / elapsed:,.0f} keys/s')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('-n', '--count', type=int, default=20000, help='Keys per backend.')
+    args = args.parse_args()
+    benchmark(args.count)
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 import argparse
 import binascii
+import concurrent.futures
+import csv
+import functools
 import hashlib
 import hmac
+import json
 import struct
-import web3
+import sys
+
+import tqdm
 import os
 from base58 import b58encode_check
-from ecdsa.curves import SECP256k1
+from eth_utils import to_checksum_address
+
+from libs import secp256k1
+from utils.streaming import read_chunks, bounded_map
 
 # from lib import style
 BIP39_PBKDF2_ROUNDS = 2048
 BIP39_SALT_MODIFIER = "mnemonic"
 BIP32_PRIVDEV = 0x80000000
-BIP32_CURVE = SECP256k1
+BIP32_CURVE_ORDER = secp256k1.N
 BIP32_SEED_MODIFIER = b'Bitcoin seed'
 LEDGER_ETH_DERIVATION_PATH = "m/44'/60'/0'/0"
 alt_paths = ["m/0'/0'", "m/44'/60'/0'/0", "m/44'/60'/0'/0", "m/0'/0", "m/44'/0'/0'", "m/49'/0'/0'/0", "m/84'/0'/0'/0",
@@ -58,24 +67,23 @@ def bip39seed_to_bip32masternode(seed: bytes):
 
 
 def derive_public_key(private_key: bytes):
-    """ Public key from a private key.
-        Logic adapted from https://github.com/satoshilabs/slips/blob/master/slip-0010/testvectors.py. """
+    """ Compressed public key from a private key, see libs.secp256k1 for the backends. """
 
-    Q = int.from_bytes(private_key, byteorder='big') * BIP32_CURVE.generator
-    xstr = Q.x().to_bytes(32, byteorder='big')
-    parity = Q.y() & 1
-    return (2 + parity).to_bytes(1, byteorder='big') + xstr
+    return secp256k1.privkey_to_pubkey(private_key)
 
 
-def derive_bip32childkey(parent_key: any, parent_chain_code: bytes, i: any):
+def derive_bip32childkey(parent_key: any, parent_chain_code: bytes, i: any, parent_public_key: bytes = None):
     """ Derives a child key from an existing key, i is current derivation parameter.
-        Logic adapted from https://github.com/satoshilabs/slips/blob/master/slip-0010/testvectors.py. """
+        Logic adapted from https://github.com/satoshilabs/slips/blob/master/slip-0010/testvectors.py.
+        parent_public_key may be supplied by callers that already know it, to skip the EC multiplication. """
 
     assert len(parent_key) == 32
     assert len(parent_chain_code) == 32
     k = parent_chain_code
     if (i & BIP32_PRIVDEV) != 0:
         key = b'\x00' + parent_key
+    elif parent_public_key is not None:
+        key = parent_public_key
     else:
         key = derive_public_key(parent_key)
     d = key + struct.pack('>L', i)
@@ -84,8 +92,8 @@ def derive_bip32childkey(parent_key: any, parent_chain_code: bytes, i: any):
         key, chain_code = h[:32], h[32:]
         a = int.from_bytes(key, byteorder='big')
         b = int.from_bytes(parent_key, byteorder='big')
-        key = (a + b) % BIP32_CURVE.order
-        if a < BIP32_CURVE.order and key != 0:
+        key = (a + b) % BIP32_CURVE_ORDER
+        if a < BIP32_CURVE_ORDER and key != 0:
             key = key.to_bytes(32, byteorder='big')
             break
         d = b'\x01' + h[32:] + struct.pack('>L', i)
@@ -148,6 +156,53 @@ def parse_derivation_path(str_derivation_path):
     return path
 
 
+class DerivationTree:
+    def __init__(self, mnemonic: str, passphrase: str = ""):
+        """
+        BIP32 derivation cache for a single mnemonic. The BIP39 seed is computed once, then every
+        intermediate (key, chain_code) node is kept, keyed by its path prefix, so deriving many
+        siblings such as m/44'/60'/0'/0/i only costs the final child step.
+        :param mnemonic: seed wordlist
+        :param passphrase: optional BIP39 passphrase
+        """
+        self.mnemonic = mnemonic
+        self.passphrase = passphrase
+        bip39seed = mnemonic_to_bip39seed(mnemonic, passphrase)
+        self.nodes: dict[tuple, tuple[bytes, bytes]] = {(): bip39seed_to_bip32masternode(bip39seed)}
+        self.public_keys: dict[tuple, bytes] = {}
+
+    def public_key(self, path: tuple) -> bytes:
+        """
+        Compressed public key of a cached node, computed once per node.
+        """
+        public_key = self.public_keys.get(path)
+        if public_key is None:
+            public_key = derive_public_key(self.node(path)[0])
+            self.public_keys[path] = public_key
+        return public_key
+
+    def node(self, path: (list, tuple)) -> (bytes, bytes):
+        """
+        (key, chain_code) for a parsed derivation path, deriving only the missing suffix.
+        """
+        path = tuple(path)
+        node = self.nodes.get(path)
+        if node is None:
+            parent = path[:-1]
+            parent_key, parent_chain_code = self.node(parent)
+            i = path[-1]
+            parent_public_key = None if i & BIP32_PRIVDEV else self.public_key(parent)
+            node = derive_bip32childkey(parent_key, parent_chain_code, i, parent_public_key)
+            self.nodes[path] = node
+        return node
+
+    def private_key(self, str_derivation_path: str = LEDGER_ETH_DERIVATION_PATH) -> bytes:
+        return self.node(parse_derivation_path(str_derivation_path))[0]
+
+    def child_private_key(self, str_derivation_path: str, index: int) -> bytes:
+        return self.node(parse_derivation_path(str_derivation_path) + [index])[0]
+
+
 def mnemonic_to_private_key(mnemonic, str_derivation_path=LEDGER_ETH_DERIVATION_PATH, passphrase="", index=0):
     """ Performs all convertions to get a private key from a mnemonic sentence, including:
 
@@ -169,18 +224,7 @@ def mnemonic_to_private_key(mnemonic, str_derivation_path=LEDGER_ETH_DERIVATION_
 
     # dp2 = dp2[:-1]
     # print(dp2)
-    derivation_path = parse_derivation_path(dp2)
-
-    bip39seed = mnemonic_to_bip39seed(mnemonic, passphrase)
-
-    master_private_key, master_chain_code = bip39seed_to_bip32masternode(bip39seed)
-
-    private_key, chain_code = master_private_key, master_chain_code
-
-    for i in derivation_path:
-        private_key, chain_code = derive_bip32childkey(private_key, chain_code, i)
-
-    return private_key
+    return DerivationTree(mnemonic, passphrase).private_key(dp2)
 
 
 def read_as_lines(file: str):
@@ -192,31 +236,106 @@ def read_as_lines(file: str):
     return lines_list
 
 
-def generate(mnemonic, path=LEDGER_ETH_DERIVATION_PATH, passphrase="", children=3):
+def generate(mnemonic, path=LEDGER_ETH_DERIVATION_PATH, passphrase="", children=3, tree: DerivationTree = None):
+    if tree is None:
+        tree = DerivationTree(mnemonic, passphrase)
     print('MNEMONIC: ', mnemonic)
     print('PATH: ', path)
-    private_key = mnemonic_to_private_key(mnemonic, path, passphrase)
-    acct = web3.Account.from_key(private_key)
-    address = acct.address
+    private_key = tree.private_key(path)
+    address = to_checksum_address(secp256k1.privkey_to_address(private_key))
     print("# Your private key is: {}".format(str(binascii.hexlify(private_key), 'utf-8')))
     if args.output:
         log_key(private_key)
     print(f'Address: {address}')
     print('Child keys: ')
     for x in range(0, children):
-        private_key = mnemonic_to_private_key(mnemonic, index=x)
-        acct = web3.Account.from_key(private_key)
-        address = acct.address
+        private_key = tree.child_private_key(path, x)
+        address = to_checksum_address(secp256k1.privkey_to_address(private_key))
         if args.output:
             log_key(private_key)
-            print("# Your private key is: {}".format(str(binascii.hexlify(private_key), 'utf-8')))
-            print(f' Index {x} , Address: {address}')
+        print("# Your private key is: {}".format(str(binascii.hexlify(private_key), 'utf-8')))
+        print(f' Index {x} , Address: {address}')
+
+
+def derive_rows(mnemonic: str, paths: list[str], passphrase: str = "", children: int = 3) -> list[tuple]:
+    """
+    Derive the key for each path, plus `children` child keys under it, from one mnemonic.
+    :return: list of (mnemonic, derivation path, private key hex, address) rows
+    """
+    tree = DerivationTree(mnemonic, passphrase)
+    rows = []
+    # alt_paths has duplicates, which would only produce duplicate rows
+    for path in dict.fromkeys(paths):
+        keys = [(path, tree.private_key(path))]
+        keys += [(f'{path}/{x}', tree.child_private_key(path, x)) for x in range(children)]
+        for derivation_path, private_key in keys:
+            address = to_checksum_address(secp256k1.privkey_to_address(private_key))
+            rows.append((mnemonic, derivation_path, private_key.hex(), address))
+    return rows
+
+
+def derive_batch(mnemonics: list[str], paths: list[str], passphrase: str = "", children: int = 3) -> list[tuple]:
+    """
+    Worker entry point for batch mode, derives every mnemonic of a chunk.
+    """
+    rows = []
+    for mnemonic in mnemonics:
+        rows.extend(derive_rows(mnemonic, paths, passphrase, children))
+    return rows
+
+
+class KeyWriter:
+    fields = ('mnemonic', 'path', 'private_key', 'address')
+
+    def __init__(self, output_file: (str, None), fmt: str = 'csv'):
+        """
+        Single buffered writer for batch mode results.
+        :param output_file: output path, or None for stdout
+        :param fmt: csv or jsonl
+        """
+        self.fmt = fmt
+        self.fh = open(output_file, 'w', buffering=1 << 20) if output_file else sys.stdout
+        self.csv = csv.writer(self.fh) if fmt == 'csv' else None
+        if self.csv is not None:
+            self.csv.writerow(self.fields)
+
+    def write(self, rows: list[tuple]):
+        if self.csv is not None:
+            self.csv.writerows(rows)
         else:
-            acct = web3.Account.from_key(private_key)
-            address = acct.address
+            self.fh.writelines(json.dumps(dict(zip(self.fields, row))) + '\n' for row in rows)
 
-            print("# Your private key is: {}".format(str(binascii.hexlify(private_key), 'utf-8')))
-            print(f' Index {x} , Address: {address}')
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+
+def batch(file_or_string: str, output_file: (str, None), paths: list[str], passphrase: str = "", children: int = 3,
+          jobs: int = None, fmt: str = 'csv', chunk_size: int = 256):
+    """
+    Stream mnemonics from disk through a process pool and write the derived keys, in input order,
+    through one buffered writer. At most a few chunks per worker are in flight, so memory stays
+    bounded regardless of the input size.
+    """
+    jobs = jobs or os.cpu_count()
+    if os.path.exists(file_or_string):
+        chunks = read_chunks(file_or_string, chunk_size)
+    else:
+        chunks = iter([[file_or_string]])
+    worker = functools.partial(derive_batch, paths=paths, passphrase=passphrase, children=children)
+    writer = KeyWriter(output_file, fmt)
+    keys_per_mnemonic = len(dict.fromkeys(paths)) * (children + 1)
+    progress = tqdm.tqdm(desc='mnemonics', unit='mnemonic', file=sys.stderr)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for rows in bounded_map(executor, worker, chunks, max_pending=jobs * 4):
+                writer.write(rows)
+                progress.update(len(rows) // keys_per_mnemonic)
+    finally:
+        progress.close()
+        writer.close()
 
 
 def log_key(k):
@@ -236,20 +355,31 @@ if __name__ == '__main__':
     args.add_argument('-ep', '--extended-paths', dest='extended_paths', action='store_true',
                       help='Try extensive derivation path list.')
     args.add_argument('-p', '--password', default="", help='Specify a password for seed.')
+    args.add_argument('-b', '--batch', action='store_true',
+                      help='Multi-core batch mode: stream mnemonics through a process pool and write '
+                           'every derived key to --output (or stdout) as csv or jsonl.')
+    args.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes for batch mode.')
+    args.add_argument('-f', '--format', type=str, default='csv', choices=['csv', 'jsonl'],
+                      help='Batch mode output format.')
     args = args.parse_args()
 
-    if args.file_or_string is not None:
+    if args.file_or_string is not None and args.batch:
+        batch(args.file_or_string, args.output, alt_paths if args.extended_paths else [LEDGER_ETH_DERIVATION_PATH],
+              args.password, args.children, args.jobs, args.format)
+    elif args.file_or_string is not None:
         if os.path.exists(args.file_or_string):
             mnemonics = read_as_lines(args.file_or_string)
         else:
             mnemonics = [args.file_or_string]
 
         for mnemonic in mnemonics:
+            # one seed per mnemonic, shared by every path and child below
+            tree = DerivationTree(mnemonic, args.password)
             if args.extended_paths:
                 extended_paths = alt_paths
                 for path in extended_paths:
-                    generate(mnemonic, path, args.password, children=args.children)
+                    generate(mnemonic, path, args.password, children=args.children, tree=tree)
             else:
-                generate(mnemonic, LEDGER_ETH_DERIVATION_PATH, args.password, args.children)
+                generate(mnemonic, LEDGER_ETH_DERIVATION_PATH, args.password, args.children, tree=tree)
     else:
         print('[!] Please supply either a string mnemonic, or a file with list of string mnemonics.')
\ No newline at end of file
@@ -8,9 +8,12 @@ import os
 import dotenv
 from eth_account.signers.local import LocalAccount
 
+from utils.jsonrpc import AsyncJsonRpcClient
+
 dotenv.load_dotenv()
-endpoint = os.environ.get('ethereum_ws_endpoint')
-w3 = web3.Web3(web3.WebsocketProvider(endpoint))
+endpoint = os.environ.get('ethereum_http_endpoint')
+# concurrent nonce lookups go out as json-rpc batches
+rpc = AsyncJsonRpcClient(endpoint)
 
 
 def parse_keys(file: str) -> list[LocalAccount]:
@@ -29,7 +32,7 @@ def parse_keys(file: str) -> list[LocalAccount]:
 
 
 async def _check_nonce(acct: LocalAccount) -> int:
-    return w3.eth.get_transaction_count(acct.address)
+    return int(await rpc.call('eth_getTransactionCount', [acct.address, 'latest']), 16)
 
 
 async def check_nonce(acct: LocalAccount):
@@ -54,7 +57,8 @@ def divide_chunks(l: list, n: int) -> list:
 async def main(file: str):
     eth_accounts = parse_keys(file)
     print(f'[+] Found {len(eth_accounts)}')
-    batches = divide_chunks(eth_accounts, 10)
+    await rpc.__ainit__()
+    batches = divide_chunks(eth_accounts, rpc.max_batch)
     for batch in batches:
         tasks = []
         for acct in batch:
@@ -63,6 +67,7 @@ async def main(file: str):
         for res in results:
             if res.get('nonce') > 0:
                 print(res)
+    await rpc.close()
 
 
 if __name__ == '__main__':
@@ -70,4 +75,9 @@ if __name__ == '__main__':
         print('usage: %s input_file' % sys.argv[0])
         exit()
     file = sys.argv[1]
+    if not endpoint:
+        # it used to read ethereum_ws_endpoint
+        print('[!] Set ethereum_http_endpoint in .env, nonceCheck batches its calls over http and no '
+              'longer uses ethereum_ws_endpoint')
+        exit(1)
     asyncio.run(main(file))
@@ -3,20 +3,27 @@ import argparse
 import binascii
 import os
 
-import aiofiles
 from eth_typing import ChecksumAddress
 from eth_utils import to_checksum_address
-from web3 import HTTPProvider, Web3
-from web3.middleware import geth_poa_middleware
 
+from exceptions.errors import IndexerError, JsonRpcError
 from utils import ahttp
+from utils.journal import Journal, read_jsonl
+from utils.jsonrpc import AsyncJsonRpcClient
+from utils.log_scanner import TransferLogScanner
+from utils.multicall import Multicall, balance_of_calldata, decode_uint
+from utils.ratelimit import ApiKeyPool, backoff_delay
+from utils.tokentx import TokenMeta, TokenTxParser
+from utils.tx_cache import TokenTxCache
 import asyncio
 import json
 import tqdm.asyncio as tqdm
-import libs.abi_lib
 import web3
 import dotenv
 
+# networks token_tx_url knows an explorer for
+INDEXER_NETWORKS = ('heco', 'bsc')
+
 
 class Acct:
     def __init__(self, key: (str, bytes, None), address: (str, None, ChecksumAddress)):
@@ -25,101 +32,258 @@ class Acct:
 
 
 class TokenData:
-    contract_address: ChecksumAddress = None
-    holder_acct: Acct = None
-    symbol: str = None
-    name: str = None
-    decimals: int = 0
-    balance: int = 0
+    __slots__ = ('contract_address', 'holder_acct', 'symbol', 'name', 'decimals', 'balance')
+
+    def __init__(self, meta: TokenMeta, holder_acct: Acct):
+        self.contract_address: ChecksumAddress = meta.contract_address
+        self.holder_acct: Acct = holder_acct
+        self.symbol: str = meta.symbol
+        self.name: str = meta.name
+        self.decimals: (str, int) = meta.decimals
+        self.balance: int = 0
 
     def as_dict(self):
         return {'contract_address': self.contract_address, 'address': self.holder_acct.address,
-                'key': self.holder_acct.key.hex(), 'symbol': self.symbol, 'name': self.name,
-                'decimals': self.decimals, 'balance': self.balance}
+                'key': self.holder_acct.key.hex() if self.holder_acct.key else None, 'symbol': self.symbol,
+                'name': self.name, 'decimals': self.decimals, 'balance': self.balance}
 
 
 class HecoScanner:
-    def __init__(self, output_file: str, network: str = 'heco', delay: float = 0.2):
+    def __init__(self, output_file: str, network: str = 'heco', delay: float = 0.2, retries: int = 5,
+                 batch_size: int = 500, resume: bool = False, tx_cache: (TokenTxCache, None) = None,
+                 offline: bool = False, backend: str = 'indexer', from_block: int = 0, log_range: int = 5000):
+        """
+        :param output_file: json report, records are journaled to output_file + '.jsonl' while scanning
+        :param network: heco or bsc, or any network with a `{network}_http_endpoint` in .env for the logs backend
+        :param delay: minimum interval between indexer requests, per API key
+        :param retries: indexer attempts per account before giving up on it
+        :param batch_size: balanceOf calls per Multicall3 eth_call
+        :param resume: keep the journal of a previous run and skip the accounts it completed
+        :param tx_cache: local tokentx cache, only transfers after the last cached block are fetched
+        :param offline: never ask the indexer, re-evaluate the tokens in tx_cache only
+        :param backend: `indexer` for the explorer tokentx APIs, `logs` to scan Transfer logs on the node
+        :param from_block: logs backend, first block to scan
+        :param log_range: logs backend, blocks per getLogs query
+        """
         dotenv.load_dotenv()
         self.delay = delay
+        self.retries = retries
         self.bscan_api_key = os.environ.get('bscan_api_key')
+        # several keys may be given as a comma separated `bscan_api_keys`, requests rotate over them
+        api_keys = [k.strip() for k in os.environ.get('bscan_api_keys', '').split(',') if k.strip()]
+        if not api_keys and self.bscan_api_key:
+            api_keys = [self.bscan_api_key]
+        self.api_keys = ApiKeyPool(api_keys if network == 'bsc' else [], rate=1 / delay if delay else 1000)
         self.network = network
         self.output_file = output_file
         self.http = None
-        self.w3: Web3 = Web3(HTTPProvider(os.environ.get(f'{network}_http_endpoint')))
-        self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        self.report_dict = {}
+        self.rpc = AsyncJsonRpcClient(os.environ.get(f'{network}_http_endpoint'))
+        self.multicall = Multicall(self.rpc, batch_size)
+        self.journal: (Journal, None) = Journal(output_file + '.jsonl', resume=resume) if output_file else None
+        self.tx_cache = tx_cache
+        self.offline = offline
+        self.log_scanner: (TransferLogScanner, None) = None
+        if backend == 'logs':
+            self.log_scanner = TransferLogScanner(self.rpc, self.multicall, network, from_block, log_range,
+                                                  retries=retries, tx_cache=tx_cache)
 
     async def __ainit__(self):
         headers = {'content-type': 'application/json'}
         self.http = ahttp.AsyncHttpClient(_headers=headers)
         await self.http.__ainit__()
+        await self.rpc.__ainit__(self.http)
 
-    async def get_token_tx_address(self, address: ChecksumAddress):
+    def token_tx_url(self, address: ChecksumAddress, api_key: str = None, startblock: int = 0) -> str:
         if self.network == 'heco':
-            url = f"""https://api.hecoinfo.com/api?module=account&action=tokentx&address={address}&startblock=0&endblock=999999999&sort=asc"""
+            url = f"""https://api.hecoinfo.com/api?module=account&action=tokentx&address={address}&startblock={startblock}&endblock=999999999&sort=asc"""
         elif self.network == 'bsc':
-            url = f"""https://api.bscscan.com/api?module=account&action=tokentx&address={address}&&startblock=0&endblock=999999999&sort=asc&apikey={self.bscan_api_key}"""
+            url = f"""https://api.bscscan.com/api?module=account&action=tokentx&address={address}&&startblock={startblock}&endblock=999999999&sort=asc&apikey={api_key}"""
         else:
             print('[!] I only wrote functionality for heco and bsc, so you have to modify me to work on %s' % self.network)
             exit(1)
-        return await self.http.request('get', path=url)
-
-    async def parse_token_addresses(self, acct: Acct, c=1):
-
-        tokens: list[TokenData] = []
-        status, ret = await self.get_token_tx_address(acct.address)
-        await asyncio.sleep(float(self.delay))
-        if status == 0:
-            if c > 4:
-                print('[!] Not-so-transient connection error... exiting')
-                exit(1)
-            await asyncio.sleep(2 * c)
-            return await self.parse_token_addresses(acct, c+1)
-        if status == 200:
-            data = ret.get('result')
-            # print(data)
-            for tx in data:
-                # print(tx)
-                token_data = TokenData()
-                token_data.holder_acct = acct
-                token_data.contract_address = to_checksum_address(tx.get('contractAddress'))
-                token_data.name = tx.get('tokenName')
-                token_data.symbol = tx.get('tokenSymbol')
-                token_data.decimals = tx.get('tokenDecimal')
-                tokens.append(token_data)
-        return tokens
-
-    def token_contract_obj(self, contract_address: ChecksumAddress):
-        return self.w3.eth.contract(contract_address, abi=libs.abi_lib.EIP20_ABI)
+        return url
+
+    async def fetch_tokens(self, address: ChecksumAddress, startblock: int = 0) -> (dict, (int, None)):
+        """
+        Fetch the token transfers of an account from the indexer, retrying with jittered backoff.
+        The response is parsed as it arrives, only the distinct tokens are kept.
+        :return: {contract: TokenMeta}, highest block seen (None without transfers)
+        :raises IndexerError: if the indexer keeps failing
+        """
+        for attempt in range(self.retries):
+            api_key = await self.api_keys.acquire()
+            parser = TokenTxParser()
+            status, ret = await self.http.request('stream', path=self.token_tx_url(address, api_key, startblock),
+                                                  feed=parser.feed)
+            if status == 200:
+                try:
+                    ret = parser.close()
+                except ValueError as err:
+                    ret = err
+                if parser.complete:
+                    return parser.tokens, parser.last_block
+                data = ret.get('result') if isinstance(ret, dict) else None
+                if isinstance(data, str) and 'rate limit' in data.lower():
+                    # over the limit for this key, drain its bucket for a bit
+                    self.api_keys.pause(api_key, 1.0)
+                elif isinstance(ret, dict) and ret.get('message', '').startswith('No transactions found'):
+                    return {}, None
+            await asyncio.sleep(backoff_delay(attempt))
+        raise IndexerError(f'Indexer failed {self.retries} times for {address}: {status} {ret}')
+
+    async def parse_token_addresses(self, acct: Acct) -> list:
+        """
+        :return: a TokenData for every distinct token the account has transferred. With a tx cache,
+        only the transfers after the last cached block are fetched and merged into the cached tokens.
+        :raises IndexerError: if the indexer keeps failing
+        """
+        fetch_tokens = self.fetch_tokens if self.log_scanner is None else self.log_scanner.fetch_tokens
+        if self.tx_cache is None:
+            tokens, _ = await fetch_tokens(acct.address)
+            tokens = tokens.values()
+        else:
+            if not self.offline:
+                last_block = self.tx_cache.last_block(self.network, acct.address)
+                startblock = 0 if last_block is None else last_block + 1
+                tokens, last_block = await fetch_tokens(acct.address, startblock)
+                self.tx_cache.update(self.network, acct.address, list(tokens.values()), last_block)
+            tokens = self.tx_cache.tokens(self.network, acct.address)
+        return [TokenData(meta, acct) for meta in tokens]
 
     async def token_balance(self, contract_address: ChecksumAddress, holder_address: ChecksumAddress) -> int:
-        contract = self.token_contract_obj(contract_address)
-        return contract.functions.balanceOf(holder_address).call()
+        return decode_uint(True, await self.rpc.eth_call(contract_address, balance_of_calldata(holder_address))) or 0
+
+    async def fill_balances(self, token_data_lst: list):
+        """
+        Look up every (token, holder) balance with Multicall3 batches. Tokens whose balanceOf
+        reverts keep a zero balance, without failing the rest of the batch.
+        :raises JsonRpcError: if the node could not be reached
+        """
+        if not token_data_lst:
+            return
+        pairs = [(data.contract_address, data.holder_acct.address) for data in token_data_lst]
+        balances = await self.multicall.balances(pairs)
+        for data, balance in zip(token_data_lst, balances):
+            if balance:
+                data.balance = balance
+                print(data.as_dict())
 
     async def log_balance(self, data: TokenData):
-        if self.report_dict.get(data.holder_acct.address):
-            self.report_dict[data.holder_acct.address].append(data.as_dict())
-        else:
-            self.report_dict[data.holder_acct.address] = [data.as_dict()]
+        if self.journal is not None:
+            self.journal.write(data.as_dict())
 
-        async with aiofiles.open(self.output_file, 'w') as f:
-            await f.write(json.dumps(self.report_dict))
+    def export_report(self):
+        """
+        Fold the journal into the nested {address: [token, ...]} report that uni2quote reads.
+        Records repeated by an interrupted run are deduplicated, the last one wins.
+        """
+        if self.journal is None:
+            return
+        self.journal.close()
+        report_dict = {}
+        for record in read_jsonl(self.journal.output_file):
+            report_dict.setdefault(record['address'], {})[record['contract_address']] = record
+        with open(self.output_file, 'w') as f:
+            json.dump({address: list(tokens.values()) for address, tokens in report_dict.items()}, f)
 
-    async def get_token_balances(self, acct: Acct):
+    async def discover_tokens(self, acct: Acct) -> list:
+        """
+        :return: one TokenData per distinct token the account has touched
+        """
         if acct is None:
-            return
-        token_data_lst = await self.parse_token_addresses(acct)
-        processed_tokens = []
-        for data in token_data_lst:
-            if not processed_tokens.__contains__(data.contract_address) and data is not None:
-
-                balance = await self.token_balance(data.contract_address, data.holder_acct.address)
-                if balance > 0:
-                    data.balance = balance
-                    print(data.as_dict())
-                processed_tokens.append(data.contract_address)
-                await self.log_balance(data)
+            return []
+        return await self.parse_token_addresses(acct)
+
+    async def get_token_balances(self, acct: Acct) -> list:
+        """
+        :return: one TokenData per distinct token the account has touched, with its balance
+        """
+        unique = await self.discover_tokens(acct)
+        await self.fill_balances(unique)
+        return unique
+
+    async def run(self, accounts: list, concurrency: int = 8, progress: tqdm.tqdm = None,
+                  balance_workers: int = 4):
+        """
+        Bounded concurrency pipeline connected by bounded queues: a feeder, `concurrency` indexer
+        workers, `balance_workers` balance workers that pack the tokens of several accounts into
+        Multicall3 batches, and a single writer. The indexer rate limit is enforced by the API key
+        pool, not by sleeping.
+        :param accounts: Acct or LocalAccount objects
+        :param concurrency: accounts fetched from the indexer at once
+        :param progress: optional progress bar, advanced once per account
+        :param balance_workers: multicall batches in flight
+        """
+        account_q = asyncio.Queue(maxsize=concurrency * 2)
+        token_q = asyncio.Queue(maxsize=concurrency * 2)
+        result_q = asyncio.Queue(maxsize=concurrency * 2)
+
+        async def feeder():
+            for acct in accounts:
+                await account_q.put(acct)
+            for _ in range(concurrency):
+                await account_q.put(None)
+
+        async def indexer_worker():
+            while True:
+                acct = await account_q.get()
+                if acct is None:
+                    return
+                try:
+                    tokens = await self.discover_tokens(acct)
+                except IndexerError as err:
+                    print(f'[!] {err}')
+                    # not checkpointed, so --resume will try this account again
+                    tokens = None
+                await token_q.put((acct, tokens))
+
+        async def balance_worker():
+            finished = False
+            while not finished:
+                item = await token_q.get()
+                if item is None:
+                    return
+                batch = [item]
+                pairs = len(item[1] or [])
+                # top the batch up with whatever else is already waiting
+                while pairs < self.multicall.batch_size and not token_q.empty():
+                    item = token_q.get_nowait()
+                    if item is None:
+                        finished = True
+                        break
+                    batch.append(item)
+                    pairs += len(item[1] or [])
+                try:
+                    await self.fill_balances([data for _, tokens in batch for data in tokens or []])
+                except JsonRpcError as err:
+                    print(f'[!] {err}')
+                    # balances unknown, not zero: not checkpointed, so --resume will try these accounts again
+                    batch = [(acct, None) for acct, _ in batch]
+                for item in batch:
+                    await result_q.put(item)
+
+        async def writer():
+            while True:
+                item = await result_q.get()
+                if item is None:
+                    return
+                acct, results = item
+                if results is not None:
+                    for data in results:
+                        await self.log_balance(data)
+                    if self.journal is not None:
+                        self.journal.complete(acct.address)
+                if progress is not None:
+                    progress.update()
+
+        writer_task = asyncio.create_task(writer())
+        balance_tasks = [asyncio.create_task(balance_worker()) for _ in range(balance_workers)]
+        await asyncio.gather(feeder(), *[indexer_worker() for _ in range(concurrency)])
+        for _ in balance_tasks:
+            await token_q.put(None)
+        await asyncio.gather(*balance_tasks)
+        await result_q.put(None)
+        await writer_task
 
     def parse_key(self, key: str):
         try:
@@ -135,31 +299,75 @@ class HecoScanner:
             return account
 
 
-async def main(file: str, output_file: str, seek: int, network: str, delay: float):
-    hs = HecoScanner(output_file, network, delay)
+async def main(file: str, output_file: str, seek: int, network: str, delay: float, concurrency: int = 8,
+               batch_size: int = 500, resume: bool = False, use_cache: bool = True, offline: bool = False,
+               backend: str = 'indexer', from_block: int = 0, log_range: int = 5000):
+    tx_cache = TokenTxCache() if use_cache or offline else None
+    hs = HecoScanner(output_file, network, delay, batch_size=batch_size, resume=resume, tx_cache=tx_cache,
+                     offline=offline, backend=backend, from_block=from_block, log_range=log_range)
     with open(file) as f:
         keys = list(sorted(set([line.strip('\r\n') for line in f.readlines()])))
     accounts = []
     for key in keys:
         accounts.append(hs.parse_key(key))
 
+    accounts = [acct for acct in accounts[seek:] if acct is not None]
+    if hs.journal is not None and hs.journal.done:
+        todo = [acct for acct in accounts if acct.address not in hs.journal]
+        print(f'[+] Resuming, {len(accounts) - len(todo)} accounts already done')
+        accounts = todo
+
     await hs.__ainit__()
-    progress = tqdm.tqdm(accounts, f'{network} scanner')
-    if len(accounts):
-        for x, acct in enumerate(progress.iterable):
-            if x >= seek:
-                await hs.get_token_balances(acct)
-            progress.update()
+    progress = tqdm.tqdm(total=len(accounts), desc=f'{network} scanner')
+    try:
+        if len(accounts):
+            await hs.run(accounts, concurrency, progress)
+    finally:
+        progress.close()
+        hs.export_report()
+        await hs.http.close()
+    if hs.log_scanner is not None:
+        print(f'[+] Tokens discovered with {hs.log_scanner.rpc_calls} eth_getLogs calls')
+    print(f'[+] Balances fetched with {hs.multicall.rpc_calls} eth_calls')
+    print(f'[+] {hs.rpc.calls} json-rpc calls sent in {hs.rpc.requests} http requests')
+    print(hs.http.metrics.summary())
 
 
 if __name__ == '__main__':
-    args = argparse.ArgumentParser()
-    args.add_argument('file', type=str)
-    args.add_argument('-o', '--output', default=None, help='Log json output to file.')
-    args.add_argument('-s', '--seek', type=int, default=0, help='Seek to.')
-    args.add_argument('-n', '--network', type=str, default='heco', choices=['heco', 'bsc'])
-    args.add_argument('-d', '--delay', type=float, default=0.2, help='Request throttling sleep interval. '
-                                                                     'In some cases, you may want '
-                                                                     'to adjust this.')
-    args = args.parse_args()
-    asyncio.run(main(args.file, args.output, args.seek, args.network, args.delay))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str)
+    parser.add_argument('-o', '--output', default=None, help='Log json output to file. Records are appended to '
+                                                              '<output>.jsonl while scanning and exported to '
+                                                              '<output> at the end.')
+    parser.add_argument('-s', '--seek', type=int, default=0, help='Seek to.')
+    parser.add_argument('-n', '--network', type=str, default='heco',
+                        help='heco or bsc for the indexer backend, any network in .env for the logs backend.')
+    parser.add_argument('-d', '--delay', type=float, default=0.2, help='Minimum interval between indexer requests, '
+                                                                       'per API key. Set several keys as a comma '
+                                                                       'separated `bscan_api_keys` in .env to go '
+                                                                       'faster.')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Accounts processed concurrently.')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=500,
+                        help='balanceOf calls per Multicall3 eth_call.')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Continue an interrupted scan of --output, skipping the accounts it completed.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Always fetch the full transfer history instead of the delta since the last scan.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not query the indexer, re-check balances of the tokens in the local cache.')
+    parser.add_argument('-B', '--backend', choices=['indexer', 'logs'], default='indexer',
+                        help='Discover tokens through the explorer tokentx API, or by scanning Transfer logs on '
+                             'the node. Accounts processed concurrently (-c) share getLogs queries, so raise -c '
+                             'for the logs backend.')
+    parser.add_argument('--from-block', dest='from_block', type=int, default=0,
+                        help='Logs backend: first block to scan.')
+    parser.add_argument('--log-range', dest='log_range', type=int, default=5000,
+                        help='Logs backend: blocks per eth_getLogs query, halved automatically when the node '
+                             'refuses a range.')
+    args = parser.parse_args()
+    if args.backend == 'indexer' and not args.offline and args.network not in INDEXER_NETWORKS:
+        parser.error(f'the indexer backend only supports {" and ".join(INDEXER_NETWORKS)}, '
+                     f'use -B logs for {args.network}')
+    asyncio.run(main(args.file, args.output, args.seek, args.network, args.delay, args.concurrency,
+                     args.batch_size, args.resume, not args.no_cache, args.offline, args.backend,
+                     args.from_block, args.log_range))
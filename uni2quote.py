@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import os
-import time
 
 import dotenv
+import numpy as np
 import tqdm
 import web3
 from eth_account.signers.local import LocalAccount
@@ -12,12 +13,22 @@ from eth_utils import to_checksum_address
 from hexbytes import HexBytes
 from web3.contract import Contract
 from web3.exceptions import ContractLogicError
-from web3.middleware import geth_poa_middleware
 from libs.style import PrettyText
 import libs.abi_lib
-import requests
+
+from exceptions.errors import JsonRpcError, PriceUnavailable
 from utils.helpers import load_json, dump_json
+from utils.journal import Journal, read_jsonl
+from utils import init_w3
 from utils.constants import Constants
+from utils.health import ConnectionHealth
+from utils.jsonrpc import AsyncJsonRpcClient
+from utils.multicall import Multicall, balance_of_calldata, decode_uint
+from utils.log_scanner import LogScanner
+from utils.pair_graph import PairGraph, Route
+from utils.price_oracle import NativePriceOracle
+from utils.reserves import ReservesEngine
+from utils.valuation import Valuation, value_portfolio
 
 zero_address = Constants.zero_address
 
@@ -35,6 +46,8 @@ class PancakeSwapDeployments:
     bsc_usdc: Token = Token("0x8AC76a51cc950d9822D68b83fE1Ad97B32Cd580d", 18)
     bsc_dai: Token = Token("0x1AF3F329e8BE154074D8769D1FFa4eE058B1DBc3", 18)
     wrapped_native: Token = Token("0xbb4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c", 18)
+    fee_bps: int = 25
+    factory_block: int = 6809737
 
     def __init__(self, _w3: web3.Web3):
         self.w3 = _w3
@@ -56,6 +69,9 @@ class MdexDeployments:
     heco_husd: Token = Token("0x0298c2b32eae4da002a15f36fdf7615bea3da047", 8)
     wrapped_native: Token = Token("0x5545153ccfca01fbd7dd11c0b23ba694d9509a6f", 18)
     heco_usdc: Token = Token("0x9362bbef4b8313a8aa9f0c9808b80577aa26b73b", 6)
+    fee_bps: int = 30
+    # not known here, found on chain by the first pair graph sync
+    factory_block: (int, None) = None
 
     def __init__(self, _w3: web3.Web3):
         self.w3 = _w3
@@ -71,90 +87,63 @@ class MdexDeployments:
 
 def setup_w3(network: str) -> (web3.Web3, False):
     dotenv.load_dotenv()
-    endpoint = os.environ.get(f'{network}_http_endpoint')
-    w3 = web3.Web3(web3.HTTPProvider(endpoint))
-    if w3.is_connected():
-        print(f'[+] Web3 connected to {w3.eth.chain_id}')
-        if w3.eth.chain_id in [56, 128, 137]:
-            w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        return w3
-    return False
+    w3 = init_w3.setup_w3(network)
+    if w3:
+        print(f'[+] Web3 connected to {w3.chain_metadata["chain_id"]}')
+    return w3
 
 
 class MdexClient:
     def __init__(self, network: str, account: (LocalAccount, str, HexBytes, None) = None, verbosity: int = 0):
         self.print = PrettyText(verbosity)
-        self.last_conn_check: int = 0
         self.network: str = network
 
-        self._w3: web3.Web3 = setup_w3(network)
+        w3 = setup_w3(network)
+        if not w3:
+            self.print.error(f'Web3 could not connect to {network}, exiting!!')
+            exit(1)
+        self.health = ConnectionHealth(w3, printer=self.print)
+        # async reads, concurrent calls share json-rpc batches. __ainit__ it before use
+        self.rpc = AsyncJsonRpcClient(os.environ.get(f'{network}_http_endpoint'))
         self.account: LocalAccount = self.setup_account(account)
         if self.network == 'heco':
             print('[+] Loading Mdex deployments')
-            self.deployments = MdexDeployments(self._w3)
+            self.deployments = MdexDeployments(self.w3)
             self.router: Contract = self.deployments.router_obj
             self.factory: Contract = self.deployments.factory_obj
             self.quote_tokens = [self.deployments.wrapped_native,
                                  self.deployments.heco_usdt,
                                  self.deployments.heco_husd,
                                  self.deployments.heco_usdc]
-            self.native_price = self.get_ht_price()
         else:
             print('[+] Loading pancake deployments')
-            self.deployments = PancakeSwapDeployments(self._w3)
+            self.deployments = PancakeSwapDeployments(self.w3)
             self.router: Contract = self.deployments.router_obj
             self.factory: Contract = self.deployments.factory_obj
             self.quote_tokens = [self.deployments.wrapped_native,
                                  self.deployments.bsc_usdt,
                                  self.deployments.bsc_usdc,
                                  self.deployments.bsc_dai]
-            self.native_price = self.get_ht_price()
+        # priced on chain against the first stable when the explorer is down
+        stable = self.quote_tokens[1]
+        self.oracle = NativePriceOracle(network, pool=(self.deployments.factory_address,
+                                                       self.deployments.wrapped_native.address,
+                                                       stable.address, stable.decimals))
+        self.multicall = Multicall(self.rpc)
+        self.reserves = ReservesEngine(self.multicall, network, self.deployments.factory_address,
+                                       self.deployments.fee_bps)
+        self.graph = PairGraph(self.reserves, LogScanner(self.rpc), self.deployments.factory_block)
 
     @property
-    def w3(self):
-        if not self.last_conn_check or self.last_conn_check - time.time() >= 60:
-            if self._w3.is_connected():
-                pass
-            else:
-                self.print.error('W3 Disconnected! Reconnecting ... ')
-                self._w3 = setup_w3(self.network)
-        return self._w3
-
-    def get_ht_price(self):
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.hecoinfo.com/',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'same-site',
-            'Sec-Fetch-User': '?1',
-        }
-
-        params = {
-            'module': 'stats',
-            'action': 'price',
-        }
-        if self.network == 'heco':
-            response = requests.get('https://api.hecoinfo.com/api', params=params, headers=headers)
-        else:
-            response = requests.get(
-                f"https://api.bscscan.com/api?module=stats&action=bnbprice&apikey={os.environ.get('bscan_api_key')}")
-        if response.status_code == 200:
-            print(response.json())
-            if self.network == 'heco':
-                price = response.json().get('result').get('coinusd')
-            else:
-                price = response.json().get('result').get('ethusd')
+    def w3(self) -> web3.Web3:
+        return self.health.w3
 
-            return float(price)
-        else:
-            err = response.text
-            self.print.error(f'Error fetching HT price from api: {err}')
-            return 0.0
+    @property
+    def native_price(self) -> float:
+        """
+        USD price of the native coin, from the shared price cache while it is fresh
+        """
+        return self.oracle.price(self.w3).price
 
     def setup_account(self, account: (LocalAccount, str, HexBytes, None)):
         """
@@ -195,6 +184,72 @@ class MdexClient:
                 return quote_out * self.native_price
             return quote_out
 
+    async def balance_of(self, token_address: (str, ChecksumAddress), holder: (str, ChecksumAddress)) -> int:
+        try:
+            ret = await self.rpc.eth_call(to_checksum_address(token_address), balance_of_calldata(holder))
+        except JsonRpcError:
+            return 0
+        return decode_uint(True, ret) or 0
+
+    async def valuation(self, items: list[tuple[ChecksumAddress, int]], native_price: float = None) -> Valuation:
+        """
+        Value many balances at once against every quote token, off chain from the reserves of the
+        pairs at one block. See ReservesEngine and value_portfolio
+        :param items: [(token address, raw amount), ...]
+        :param native_price: USD price of the native coin, so that every chunk of a report is valued at
+        the same one without asking the oracle. Defaults to native_price
+        """
+        if native_price is None:
+            native_price = self.native_price
+        swaps = [(to_checksum_address(token_address), token.address)
+                 for token_address, _ in items for token in self.quote_tokens]
+        # a quote token is not quoted against itself, there is no such pair
+        reserves = await self.reserves.pair_reserves([swap for swap in swaps if swap[0] != swap[1]])
+        reserves = iter(reserves)
+        q = len(self.quote_tokens)
+        rows = [[(0, 0) if token_in == token_out else next(reserves) for token_in, token_out in swaps[i:i + q]]
+                for i in range(0, len(swaps), q)]
+        prices = [native_price if token.address == self.deployments.wrapped_native.address else 1.0
+                  for token in self.quote_tokens]
+        return value_portfolio([amount for _, amount in items], rows, [token.decimals for token in self.quote_tokens],
+                               prices, self.deployments.fee_bps)
+
+    async def quote_many(self, items: list[tuple[ChecksumAddress, int]]) -> list[float]:
+        """
+        :param items: [(token address, raw amount), ...]
+        :return: the value of each item through the best quote token, 0 if there is none
+        """
+        return (await self.valuation(items)).value.tolist()
+
+    async def sync_graph(self):
+        """
+        Index the pairs created since the last run into the pair graph
+        """
+        added = await self.graph.sync()
+        if added:
+            self.print.normal(f'Pair graph: {added} new pairs')
+
+    async def routes(self, items: list[tuple[ChecksumAddress, int]], max_hops: int = 3) -> list[(Route, None)]:
+        """
+        Best multi hop route of each balance to a USD stable, for tokens without a direct pair to a
+        quote token. Call sync_graph first
+        :param items: [(token address, raw amount), ...]
+        :param max_hops: pairs per route
+        :return: Route per item, its value in USD, None where there is no route with liquidity
+        """
+        stables = [(token.address, token.decimals) for token in self.quote_tokens
+                   if token.address != self.deployments.wrapped_native.address]
+        return await self.graph.routes(items, stables, max_hops)
+
+    async def quote_async(self, token_address: ChecksumAddress, amount: int):
+        """
+        Same as quote, from pair reserves. Use quote_many for more than one token
+        :param amount: raw token balance
+        :param token_address:
+        :return: the best quote
+        """
+        return (await self.quote_many([(token_address, amount)]))[0]
+
     def quote(self, token_address: ChecksumAddress, amount: int):
         """
         uint256: { "0": "451589303671210092782648", "1": "170612273489226474404698", "reserveA": "451589303671210092782648", "reserveB": "170612273489226474404698" }
@@ -231,22 +286,94 @@ def quote(mdex: MdexClient, token, amount):
     return mdex.quote(web3.Web3.to_checksum_address(token), int(amount))
 
 
-def main(file: str, output_file: str = None, threshold: float = 0, verbosity: int = 0, network: str = 'heco'):
+async def quote_async(mdex: MdexClient, token, amount):
+    if int(amount) <= 0:
+        return 0
+    return await mdex.quote_async(web3.Web3.to_checksum_address(token), int(amount))
+
+
+async def main(file: str, output_file: str = None, threshold: float = 0, verbosity: int = 0, network: str = 'heco',
+               max_hops: int = 1, refresh: bool = False, concurrency: int = 4, chunk_size: int = 1000,
+               resume: bool = False):
     mdex = MdexClient(network, 'keys/default_wallet.json', verbosity)
+    await mdex.rpc.__ainit__()
+    try:
+        native = mdex.oracle.price(mdex.w3)
+    except PriceUnavailable as err:
+        mdex.print.warning(f'{err}, balances are only valued through the stables')
+        native_price = 0.0
+    else:
+        native_price = native.price
+        mdex.print.normal(f'Native price: ${native.price:,.2f} ({native.source}, {native.age:.0f}s old)')
+        if native.age > mdex.oracle.ttl:
+            mdex.print.warning('The native price is stale, the explorer and the chain did not answer')
     token_dict = load_json(file)
-
-    for acct, data_list in tqdm.tqdm(token_dict.items()):
-        for x, data in enumerate(data_list):
-            token_address = data.get('contract_address')
-            balance = mdex.deployments.contract_object(token_address, libs.abi_lib.EIP20_ABI).functions.balanceOf(
-                acct).call()
-            # print(balance)
-            if balance > 0:
-                _quote = quote(mdex, token_address, balance)
-                if _quote > 0 and _quote > threshold:
-                    token_dict[acct][x].update({'quote': _quote})
-                    dump_json(output_file, token_dict)
-                    print(token_dict[acct][x])
+    # hits are appended to <output>.jsonl as they come, the report is written at the end
+    journal = Journal(output_file + '.jsonl', resume=resume) if output_file else None
+
+    items = [(acct, x, to_checksum_address(data.get('contract_address')), data.get('balance'))
+             for acct, data_list in token_dict.items() for x, data in enumerate(data_list)]
+    if journal is not None and journal.done:
+        # the hits of the interrupted run go into the report too
+        positions = {(acct, token): x for acct, x, token, _ in items}
+        for record in read_jsonl(journal.output_file):
+            acct = record.pop('holder')
+            x = positions.get((acct, to_checksum_address(record['contract_address'])))
+            if x is not None:
+                token_dict[acct][x].update(record)
+        items = [item for item in items if f'{item[0]}:{item[2]}' not in journal]
+    if max_hops > 1:
+        await mdex.sync_graph()
+    progress = tqdm.tqdm(total=len(items), desc=f'{network} quotes', unit='token')
+    slots = asyncio.Semaphore(concurrency)
+
+    async def read_chunk(chunk: list[tuple]) -> tuple[dict[int, dict], list[int]]:
+        # the scanner already recorded the balances, only ask the ones it did not
+        stale = [i for i, (_, _, _, balance) in enumerate(chunk) if refresh or balance is None]
+        balances = [int(balance or 0) for _, _, _, balance in chunk]
+        if stale:
+            fresh = await mdex.multicall.balances([(chunk[i][2], chunk[i][0]) for i in stale])
+            for i, balance in zip(stale, fresh):
+                balances[i] = balance or 0
+        valuation = await mdex.valuation([(token, balance) for (_, _, token, _), balance in zip(chunk, balances)],
+                                         native_price)
+        hits = {i: valuation.row(i) for i in np.flatnonzero(valuation.mask(threshold))}
+        if max_hops > 1:
+            # whatever has no direct pair to a quote token may still have a route through other pairs
+            unpriced = [i for i in np.flatnonzero(valuation.value == 0) if balances[i]]
+            routes = await mdex.routes([(chunk[i][2], balances[i]) for i in unpriced], max_hops)
+            hits.update({i: {'quote': route.value, 'route': route.path}
+                         for i, route in zip(unpriced, routes) if route is not None and route.value > threshold})
+        return hits, balances
+
+    async def quote_chunk(chunk: list[tuple]):
+        async with slots:
+            try:
+                hits, balances = await read_chunk(chunk)
+            except JsonRpcError as err:
+                # nothing was valued, not checkpointed so that --resume quotes the chunk again
+                progress.write(f'[!] {err}')
+                progress.update(len(chunk))
+                return
+        for i, (acct, x, token, _) in enumerate(chunk):
+            if i in hits:
+                token_dict[acct][x].update(hits[i], balance=balances[i])
+                progress.write(str(token_dict[acct][x]))
+                if journal is not None:
+                    journal.write({'holder': acct, **token_dict[acct][x]})
+            if journal is not None:
+                journal.complete(f'{acct}:{token}')
+        progress.update(len(chunk))
+
+    await asyncio.gather(*[quote_chunk(items[i:i + chunk_size]) for i in range(0, len(items), chunk_size)])
+    progress.close()
+    if journal is not None:
+        journal.close()
+    dump_json(output_file, token_dict)
+    await mdex.rpc.close()
+    if verbosity:
+        mdex.print.debug(f'{mdex.rpc.requests} rpc requests, {mdex.multicall.rpc_calls} multicalls')
+        mdex.print.debug(mdex.health.summary())
 
 
 if __name__ == '__main__':
@@ -262,8 +389,19 @@ if __name__ == '__main__':
     list_quote = subparsers.add_parser('list')
     list_quote.add_argument('-f', '--file', type=str)
     list_quote.add_argument('-o', '--output', type=str, default=None)
-    list_quote.add_argument('-t', '--threshold', type=float, default=0)
+    list_quote.add_argument('-H', '--max-hops', dest='max_hops', type=int, default=1, choices=[1, 2, 3],
+                            help='Route tokens without a direct pair through up to this many pairs (2 or 3), '
+                                 'from a local graph of the factory pairs')
+    list_quote.add_argument('-t', '--threshold', type=float, default=0,
+                            help='Only report balances worth more than this, in USD')
+    list_quote.add_argument('--refresh', action='store_true',
+                            help='Look up every balance again instead of using the ones in the scanner report')
+    list_quote.add_argument('-c', '--concurrency', type=int, default=4, help='Chunks of tokens quoted at once')
+    list_quote.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000, help='Tokens per chunk')
+    list_quote.add_argument('-r', '--resume', action='store_true',
+                            help='Keep <output>.jsonl of an interrupted run and skip the tokens it completed')
     args.add_argument('-v', '--verbosity', action='count', default=0)
 
     args = args.parse_args()
-    main(args.file, args.output, args.threshold, args.verbosity, args.network)
+    asyncio.run(main(args.file, args.output, args.threshold, args.verbosity, args.network, args.max_hops,
+                     args.refresh, args.concurrency, args.chunk_size, args.resume))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Compact on-disk index of 20 byte addresses, for matching against very large target sets.
+
+Layout: a 32 byte header, a bloom filter, then the sorted, deduplicated, fixed width 20 byte
+records. The file is memory mapped read only, so every worker process can open the same
+index and the OS shares the pages between them.
+
+Build an index from a text file of addresses (one per line):
+    python -m utils.address_index build addresses.txt addresses.idx
+Look up addresses:
+    python -m utils.address_index lookup addresses.idx 0xabc... 0xdef...
+"""
+import argparse
+import bisect
+import heapq
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'EVMADDR1'
+HEADER = struct.Struct('<8sQQII')
+RECORD_SIZE = 20
+
+
+def parse_address(line: str) -> bytes:
+    """
+    :param line: hex address, with or without 0x, any case
+    :return: raw 20 byte address
+    :raises ValueError: if this is not an address
+    """
+    line = line.strip()
+    if line.startswith(('0x', '0X')):
+        line = line[2:]
+    address = bytes.fromhex(line)
+    if len(address) != RECORD_SIZE:
+        raise ValueError('Not a 20 byte address: %s' % line)
+    return address
+
+
+def bloom_positions(address: bytes, m: int, k: int):
+    """
+    Addresses are keccak output, so their bytes are already uniformly distributed and can be
+    used as the two base hashes for double hashing, no extra hashing needed.
+    """
+    h1 = int.from_bytes(address[:8], 'little')
+    h2 = int.from_bytes(address[8:16], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+
+class _Records:
+    """
+    Sequence view over the sorted records of a mapped index, for bisect.
+    """
+
+    def __init__(self, mm: mmap.mmap, offset: int, count: int):
+        self.mm = mm
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self.offset + i * RECORD_SIZE
+        return self.mm[start:start + RECORD_SIZE]
+
+
+class AddressIndex:
+    def __init__(self, path: str):
+        """
+        Read only, memory mapped address index.
+        :param path: file created by build_index
+        """
+        self.path = path
+        self._f = open(path, 'rb')
+        self.mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.bloom_bits, self.bloom_hashes, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an address index' % path)
+        self.bloom_offset = HEADER.size
+        self.records_offset = self.bloom_offset + self.bloom_bits // 8
+        self.records = _Records(self.mm, self.records_offset, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, address: bytes) -> bool:
+        mm = self.mm
+        offset = self.bloom_offset
+        for pos in bloom_positions(address, self.bloom_bits, self.bloom_hashes):
+            if not mm[offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        i = bisect.bisect_left(self.records, address)
+        return i < self.count and self.records[i] == address
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.records[i]
+
+    def __getstate__(self):
+        # mmaps can't be pickled, workers reopen the same file instead
+        return {'path': self.path}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['path'])
+
+    def close(self):
+        self.mm.close()
+        self._f.close()
+
+
+def _write_run(addresses: list[bytes], tmp_dir: str) -> str:
+    addresses.sort()
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b''.join(addresses))
+    return path
+
+
+def _read_run(path: str):
+    with open(path, 'rb') as f:
+        while True:
+            record = f.read(RECORD_SIZE)
+            if not record:
+                break
+            yield record
+
+
+def build_index(input_file: str, output_file: str, bits_per_entry: int = 10, run_size: int = 5_000_000) -> int:
+    """
+    Build an index from a text file of addresses. Input is sorted in bounded memory runs of
+    `run_size` addresses which are then merged, so the input may be larger than RAM.
+    :param input_file: one address per line, invalid lines are skipped
+    :param output_file: index path
+    :param bits_per_entry: bloom filter bits per address, 10 gives a ~1% false positive rate
+    :param run_size: addresses per sorted run
+    :return: number of distinct addresses written
+    """
+    tmp_dir = os.path.dirname(os.path.abspath(output_file))
+    runs = []
+    total = 0
+    run = []
+    try:
+        with open(input_file, 'r') as f:
+            for line in f:
+                try:
+                    run.append(parse_address(line))
+                except ValueError:
+                    continue
+                if len(run) >= run_size:
+                    runs.append(_write_run(run, tmp_dir))
+                    total += len(run)
+                    run = []
+        if run:
+            runs.append(_write_run(run, tmp_dir))
+            total += len(run)
+        del run
+
+        # size the filter for the upper bound, duplicates only make it a little sparser
+        m = max(64, math.ceil(total * bits_per_entry / 64) * 64)
+        k = max(1, round(bits_per_entry * math.log(2)))
+        bloom = bytearray(m // 8)
+        count = 0
+        last = None
+        with open(output_file, 'wb') as out:
+            out.seek(HEADER.size + len(bloom))
+            for address in heapq.merge(*[_read_run(path) for path in runs]):
+                if address == last:
+                    continue
+                last = address
+                out.write(address)
+                for pos in bloom_positions(address, m, k):
+                    bloom[pos >> 3] |= 1 << (pos & 7)
+                count += 1
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, count, m, k, 0))
+            out.write(bloom)
+    finally:
+        for path in runs:
+            os.remove(path)
+    return count
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    subparsers = args.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Build an index from a text list of addresses.')
+    build.add_argument('input', type=str)
+    build.add_argument('output', type=str)
+    build.add_argument('-b', '--bits', type=int, default=10, help='Bloom filter bits per address.')
+    lookup = subparsers.add_parser('lookup', help='Check addresses against an index.')
+    lookup.add_argument('index', type=str)
+    lookup.add_argument('addresses', nargs='+')
+    args = args.parse_args()
+
+    if args.command == 'build':
+        n = build_index(args.input, args.output, args.bits)
+        print(f'[+] Wrote {n} addresses to {args.output}')
+    else:
+        index = AddressIndex(args.index)
+        for addr in args.addresses:
+            print(f'{addr}: {parse_address(addr) in index}')
@@ -1,17 +1,88 @@
 import asyncio
+import collections
+import email.utils
 import json
+import time
+from urllib.parse import urlsplit
+
 import aiohttp
 
+from utils.ratelimit import backoff_delay
+
+# worth another try, anything else is the final answer
+RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+RETRY_ERRORS = (asyncio.TimeoutError, aiohttp.ServerDisconnectedError, aiohttp.ClientConnectorError,
+                aiohttp.ClientOSError, aiohttp.ClientPayloadError)
+
+
+def retry_after(response: aiohttp.ClientResponse) -> (float, None):
+    """
+    :return: seconds to wait according to the Retry-After header (delay or http date), None without one
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpMetrics:
+    def __init__(self):
+        """
+        Counters of an AsyncHttpClient, per host. Latency is the time to the response headers.
+        """
+        self.requests: collections.Counter = collections.Counter()
+        self.retries: collections.Counter = collections.Counter()
+        self.errors: collections.Counter = collections.Counter()
+        self.statuses: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        self.latency: collections.Counter = collections.Counter()
+        self.max_latency: dict[str, float] = collections.defaultdict(float)
+
+    def observe(self, host: str, status: int, seconds: float):
+        self.requests[host] += 1
+        self.statuses[host][status] += 1
+        self.latency[host] += seconds
+        self.max_latency[host] = max(self.max_latency[host], seconds)
+
+    def summary(self) -> str:
+        lines = []
+        for host in sorted(set(self.requests) | set(self.errors)):
+            requests = self.requests[host]
+            avg = self.latency[host] / requests if requests else 0.0
+            statuses = ' '.join(f'{status}:{count}' for status, count in sorted(self.statuses[host].items()))
+            lines.append(f'{host}: {requests} responses ({statuses}), {self.retries[host]} retries, '
+                         f'{self.errors[host]} errors, {avg * 1000:.0f}ms avg, '
+                         f'{self.max_latency[host] * 1000:.0f}ms max')
+        return '\n'.join(lines)
+
 
 class AsyncHttpClient:
 
-    def __init__(self, _headers=None, base_url: str = None, timeout: (int, float) = 60):
+    def __init__(self, _headers=None, base_url: str = None, timeout: (int, float) = 60, retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 30.0, limit: int = 100, limit_per_host: int = 16,
+                 keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300, verify_ssl: bool = True):
         """
         A skeletal asynchronous HTTP class. Because I found myself writing this same code
         hundreds of times, I decided to just write a reusable module.
+        Requests that time out, drop the connection or get a 408/429/5xx are retried with jittered
+        exponential backoff, or after the server's Retry-After if it sent one.
         :param _headers:
         :param base_url:
         :param timeout:
+        :param retries: extra attempts per request
+        :param backoff: delay of the first retry
+        :param max_backoff: longest wait between attempts, Retry-After included
+        :param limit: open connections in total
+        :param limit_per_host: open connections per host
+        :param keepalive_timeout: seconds an idle connection is kept for reuse
+        :param dns_cache_ttl: seconds a resolved host is cached
+        :param verify_ssl: default for requests that do not say otherwise
         """
         if _headers is None:
             _headers = {}
@@ -20,6 +91,15 @@ class AsyncHttpClient:
         self._session: (aiohttp.ClientSession, None) = None
         self.is_a_initialized: bool = False
         self.global_headers: dict = _headers
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.keepalive_timeout: float = keepalive_timeout
+        self.dns_cache_ttl: int = dns_cache_ttl
+        self.verify_ssl: bool = verify_ssl
+        self.metrics = HttpMetrics()
 
     async def __ainit__(self):
         """
@@ -28,9 +108,12 @@ class AsyncHttpClient:
         """
         timeout = aiohttp.ClientTimeout(total=self.timeout_secs, connect=(self.timeout_secs / 3),
                               sock_connect=(self.timeout_secs / 3), sock_read=(self.timeout_secs / 3))
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout, use_dns_cache=True,
+                                         ttl_dns_cache=self.dns_cache_ttl)
         self._session: aiohttp.ClientSession = aiohttp.ClientSession(headers=self.global_headers,
                                                                      base_url=self.base_url,
-                                                                     timeout=timeout)
+                                                                     timeout=timeout, connector=connector)
         self.is_a_initialized = True
 
     async def parse_response(self, response: aiohttp.ClientResponse) -> (int, (dict, bytes)):
@@ -51,37 +134,92 @@ class AsyncHttpClient:
             resp = await response.read()
         return status, resp
 
-    async def post(self, path: str, data=None, verify_ssl: bool = False) -> (int, (dict, bytes)):
+    async def _send(self, method: str, path: str, handler, verify_ssl: bool = None, retry_body: bool = True,
+                    **kwargs):
+        """
+        Send a request, retrying as configured, and return what `handler` makes of the response
+        :param handler: coroutine function taking the response
+        :param verify_ssl: None for the client default
+        :param retry_body: whether errors while `handler` reads the body may be retried, False once
+        the body is consumed incrementally
+        """
+        host = urlsplit(str(path)).netloc or str(self.base_url)
+        ssl = self.verify_ssl if verify_ssl is None else verify_ssl
+        attempt = 0
+        consumed = False
+        while True:
+            start = time.monotonic()
+            delay = None
+            try:
+                async with self._session.request(method, path, ssl=bool(ssl), **kwargs) as response:
+                    self.metrics.observe(host, response.status, time.monotonic() - start)
+                    if response.status in RETRY_STATUSES and attempt < self.retries:
+                        delay = retry_after(response)
+                    else:
+                        consumed = not retry_body
+                        return await handler(response)
+            except RETRY_ERRORS:
+                self.metrics.errors[host] += 1
+                if consumed or attempt >= self.retries:
+                    raise
+            attempt += 1
+            self.metrics.retries[host] += 1
+            if delay is None:
+                delay = backoff_delay(attempt - 1, self.backoff, self.max_backoff)
+            await asyncio.sleep(min(delay, self.max_backoff))
+
+    async def post(self, path: str, data=None, verify_ssl: bool = None) -> (int, (dict, bytes)):
         """
         HTTP post request
         :param path: URL
         :param data: payload
-        :param verify_ssl: ignore ssl warnings
+        :param verify_ssl: None for the client default (verify)
         :return: status, resp
         """
         if data is None:
             data = {}
-        session: aiohttp.ClientSession = self._session
-        async with session.post(url=path, json=data, verify_ssl=verify_ssl) as response:
-            return await self.parse_response(response)
+        return await self._send('POST', path, self.parse_response, verify_ssl, json=data)
 
-    async def get(self, path: str, params=None, verify_ssl: bool = False) -> (int, (dict, bytes)):
+    async def get(self, path: str, params=None, verify_ssl: bool = None) -> (int, (dict, bytes)):
         """
         HTTP GET request
         :param path: URL
         :param params: query parameters (ie ?&param=value)
-        :param verify_ssl: bool
+        :param verify_ssl: None for the client default (verify)
         :return: status, resp
         """
         if params is None:
             params = {}
-        async with self._session.get(url=path, params=params, verify_ssl=verify_ssl) as response:
-            return await self.parse_response(response)
+        return await self._send('GET', path, self.parse_response, verify_ssl, params=params)
+
+    async def stream(self, path: str, feed, params=None, verify_ssl: bool = None,
+                     chunk_size: int = 65536) -> (int, bytes):
+        """
+        HTTP GET request that hands the body to `feed` chunk by chunk instead of buffering it. Only
+        failures before the first chunk are retried, `feed` never sees a body twice.
+        :param path: URL
+        :param feed: callable taking each bytes chunk of a 200 response
+        :param params: query parameters
+        :param verify_ssl: None for the client default (verify)
+        :param chunk_size: max bytes per chunk
+        :return: status, b'' or the body of a non 200 response
+        """
+        if params is None:
+            params = {}
+
+        async def handler(response: aiohttp.ClientResponse):
+            if response.status != 200:
+                return response.status, await response.read()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                feed(chunk)
+            return response.status, b''
+
+        return await self._send('GET', path, handler, verify_ssl, retry_body=False, params=params)
 
     async def request(self, method: str, *args, **kwargs):
         """
         wrapper function for making requests
-        :param method: get, or post
+        :param method: get, post or stream
         :param args: arguments
         :param kwargs: keyword arguments
         :return: status, resp
@@ -95,7 +233,7 @@ class AsyncHttpClient:
                 # resp = self.session.get(url, verify=False)
                 status, resp = await coro
             except (aiohttp.ClientResponseError, aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError,
-                    aiohttp.ClientOSError) as err:
+                    aiohttp.ClientOSError, aiohttp.ClientPayloadError) as err:
                 print('[!] HTTP Request error %s' % err)
             except asyncio.exceptions.TimeoutError:
                 print('[!] Timed out ...  ')
@@ -106,6 +244,11 @@ class AsyncHttpClient:
             finally:
                 return status, resp
 
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self.is_a_initialized = False
+
     async def demo(self, url_path: str, method: str = 'get'):
         """
         Just do an HTTP get
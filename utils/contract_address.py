@@ -0,0 +1,42 @@
+from eth_hash.auto import keccak
+
+CREATE2_PREFIX = b'\xff'
+
+
+def rlp_nonce(nonce: int) -> bytes:
+    """
+    RLP encoding of an integer nonce, 0 is the empty string.
+    """
+    if nonce == 0:
+        return b'\x80'
+    if nonce < 0x80:
+        return bytes((nonce,))
+    raw = nonce.to_bytes((nonce.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 + len(raw),)) + raw
+
+
+def create_address(sender: bytes, nonce: int) -> bytes:
+    """
+    CREATE address as raw bytes: keccak(rlp([sender, nonce]))[12:]. The list is always shorter
+    than 56 bytes, so the rlp is a one byte list header, 0x94 + sender, then the nonce.
+    """
+    payload = b'\x94' + sender + rlp_nonce(nonce)
+    return keccak(bytes((0xc0 + len(payload),)) + payload)[12:]
+
+
+def create_addresses(sender: bytes, nonces: range):
+    """
+    CREATE addresses of one sender over a nonce range, with the fixed rlp prefix built once.
+    :return: generator of (nonce, address bytes)
+    """
+    prefix = b'\x94' + sender
+    for nonce in nonces:
+        payload = prefix + rlp_nonce(nonce)
+        yield nonce, keccak(bytes((0xc0 + len(payload),)) + payload)[12:]
+
+
+def create2_address(deployer: bytes, salt: bytes, init_code_hash: bytes) -> bytes:
+    """
+    CREATE2 address as raw bytes: keccak(0xff ++ deployer ++ salt ++ keccak(init_code))[12:]
+    """
+    return keccak(CREATE2_PREFIX + deployer + salt + init_code_hash)[12:]
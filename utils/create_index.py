@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Reverse lookup from a CREATE contract address to its (deployer, nonce), for a fixed set of
+deployers over nonces 0 .. N - 1.
+
+Layout: a 40 byte header, the 20 byte deployer addresses, then an open addressing hash table
+of 12 byte slots (4 byte address tag, 4 byte deployer index, 4 byte nonce). The table is keyed
+by the contract address itself, which is keccak output and needs no further hashing. A tag hit
+is confirmed by recomputing the address, so slots don't have to store all 20 bytes.
+
+Build an index:
+    python -m utils.create_index build deployers.txt deployers.cidx -n 1000
+Query addresses, or a file of them:
+    python -m utils.create_index query deployers.cidx 0xabc... [-f contracts.txt]
+"""
+import argparse
+import concurrent.futures
+import functools
+import itertools
+import mmap
+import os
+import struct
+
+from eth_utils import to_checksum_address
+
+from utils.address_index import parse_address
+from utils.contract_address import create_address, create_addresses
+from utils.streaming import bounded_map, read_chunks
+
+MAGIC = b'EVMCRIX1'
+HEADER = struct.Struct('<8sQQQQ')
+SLOT = struct.Struct('<III')
+EMPTY = 0xFFFFFFFF
+MAX_LOAD = 0.5
+
+
+def _slot_hash(address: bytes) -> int:
+    return int.from_bytes(address[:8], 'little')
+
+
+def _tag(address: bytes) -> int:
+    return int.from_bytes(address[8:12], 'little')
+
+
+def _contract_addresses(deployers: list[bytes], nonces: int) -> list[bytes]:
+    """
+    Worker entry point for the build, returns every contract address of each deployer as one blob.
+    """
+    return [b''.join(address for _, address in create_addresses(deployer, range(nonces))) for deployer in deployers]
+
+
+class ContractIndex:
+    def __init__(self, path: str):
+        """
+        Read only, memory mapped reverse CREATE index.
+        :param path: file created by build_index
+        """
+        self.path = path
+        self._f = open(path, 'rb')
+        self.mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.deployer_count, self.nonce_count, self.slots, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a contract index' % path)
+        self.table_offset = HEADER.size + self.deployer_count * 20
+
+    def deployer(self, i: int) -> bytes:
+        start = HEADER.size + i * 20
+        return self.mm[start:start + 20]
+
+    def lookup(self, address: bytes) -> (tuple[bytes, int], None):
+        """
+        :param address: raw 20 byte contract address
+        :return: (deployer, nonce), or None if it was not created by an indexed deployer
+        """
+        mask = self.slots - 1
+        tag = _tag(address)
+        i = _slot_hash(address) & mask
+        while True:
+            slot_tag, deployer_index, nonce = SLOT.unpack_from(self.mm, self.table_offset + i * SLOT.size)
+            if deployer_index == EMPTY:
+                return None
+            if slot_tag == tag:
+                deployer = self.deployer(deployer_index)
+                if create_address(deployer, nonce) == address:
+                    return deployer, nonce
+            i = (i + 1) & mask
+
+    def lookup_many(self, addresses):
+        """
+        :param addresses: iterable of raw 20 byte addresses
+        :return: generator of (address, (deployer, nonce) or None)
+        """
+        for address in addresses:
+            yield address, self.lookup(address)
+
+    def close(self):
+        self.mm.close()
+        self._f.close()
+
+
+def build_index(deployers_file: str, output_file: str, nonces: int, jobs: int = os.cpu_count()) -> int:
+    """
+    Precompute the CREATE addresses of every deployer for nonces 0 .. nonces - 1. Addresses are
+    hashed in a process pool, the parent inserts them straight into the mapped output file.
+    :param deployers_file: one deployer address per line
+    :param output_file: index path
+    :param nonces: nonces per deployer
+    :param jobs: worker processes
+    :return: number of indexed contract addresses
+    """
+    deployers = []
+    for chunk in read_chunks(deployers_file, 4096):
+        for line in chunk:
+            try:
+                deployers.append(parse_address(line))
+            except ValueError:
+                continue
+    deployers = list(dict.fromkeys(deployers))
+    if len(deployers) >= EMPTY or nonces >= EMPTY:
+        raise ValueError('Too many deployers or nonces for a 32 bit index')
+    entries = len(deployers) * nonces
+    slots = 1
+    while slots * MAX_LOAD < max(entries, 1):
+        slots <<= 1
+    table_offset = HEADER.size + len(deployers) * 20
+    size = table_offset + slots * SLOT.size
+    with open(output_file, 'wb') as f:
+        f.truncate(size)
+    with open(output_file, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), size)
+        try:
+            mm[:table_offset] = HEADER.pack(MAGIC, len(deployers), nonces, slots, 0) + b''.join(deployers)
+            # all 0xff marks every slot empty
+            step = 1 << 20
+            for offset in range(table_offset, size, step):
+                end = min(offset + step, size)
+                mm[offset:end] = b'\xff' * (end - offset)
+            mask = slots - 1
+            chunk_size = max(1, 65536 // max(nonces, 1))
+            chunks = [deployers[i:i + chunk_size] for i in range(0, len(deployers), chunk_size)]
+            worker = functools.partial(_contract_addresses, nonces=nonces)
+            deployer_index = 0
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                for blobs in bounded_map(executor, worker, chunks, max_pending=jobs * 4):
+                    for blob in blobs:
+                        for nonce in range(nonces):
+                            address = blob[nonce * 20:nonce * 20 + 20]
+                            i = _slot_hash(address) & mask
+                            while SLOT.unpack_from(mm, table_offset + i * SLOT.size)[1] != EMPTY:
+                                i = (i + 1) & mask
+                            SLOT.pack_into(mm, table_offset + i * SLOT.size, _tag(address), deployer_index, nonce)
+                        deployer_index += 1
+            mm.flush()
+        finally:
+            mm.close()
+    return entries
+
+
+def _parse_queries(lines):
+    """
+    :return: generator of raw addresses, malformed lines are reported and skipped
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield parse_address(line)
+        except ValueError:
+            print(f'[!] bad address: {line.strip()}')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    subparsers = args.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Index the CREATE addresses of a list of deployers.')
+    build.add_argument('deployers', type=str, help='File with one deployer address per line.')
+    build.add_argument('output', type=str)
+    build.add_argument('-n', '--nonces', type=int, default=1000, help='Index nonces 0 .. n - 1.')
+    build.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    query = subparsers.add_parser('query', help='Resolve contract addresses to (deployer, nonce).')
+    query.add_argument('index', type=str)
+    query.add_argument('addresses', nargs='*')
+    query.add_argument('-f', '--file', type=str, default=None, help='File with one contract address per line.')
+    args = args.parse_args()
+
+    if args.command == 'build':
+        n = build_index(args.deployers, args.output, args.nonces, args.jobs)
+        print(f'[+] Indexed {n} contract addresses in {args.output}')
+    else:
+        index = ContractIndex(args.index)
+        queries = _parse_queries(args.addresses)
+        if args.file:
+            from_file = _parse_queries(line for chunk in read_chunks(args.file) for line in chunk)
+            queries = itertools.chain(queries, from_file)
+        for contract, result in index.lookup_many(queries):
+            if result is None:
+                print(f'{to_checksum_address(contract)}: not found')
+            else:
+                deployer, nonce = result
+                print(f'{to_checksum_address(contract)}: deployer {to_checksum_address(deployer)}, nonce {nonce}')
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import requests
+import web3
+
+from libs.style import PrettyText
+from utils.init_w3 import make_provider
+
+# what says the connection is broken, json-rpc errors do not
+TRANSPORT_ERRORS = (requests.RequestException, OSError)
+
+
+class ConnectionHealth:
+    def __init__(self, w3: web3.Web3, max_age: float = 60.0, printer: PrettyText = None, fresh: bool = True):
+        """
+        Keeps a web3 connection from init_w3.connect alive without a round trip per use. Every
+        request that gets an answer counts as a liveness check, so is_connected is only asked after
+        `max_age` seconds without one. A transport error marks the connection down and the next
+        access to `w3` reconnects it: the provider is replaced with one on new http sessions, the
+        Web3 instance and the contracts made from it stay valid.
+        :param w3: connection to watch, its middleware is added here
+        :param max_age: seconds a successful request or check is trusted for
+        :param printer: reports reconnects, silent without one
+        :param fresh: `w3` was just made by connect, so it is trusted for `max_age` like an answered
+        request. A dead endpoint still shows up on the first transport error
+        """
+        self._w3 = w3
+        self.max_age = max_age
+        self.print = printer
+        self.last_ok: float = time.monotonic() if fresh else 0.0
+        self.down: bool = False
+        self.checks: int = 0
+        self.transport_errors: int = 0
+        self.reconnects: int = 0
+        self.failed_reconnects: int = 0
+        self._lock = threading.Lock()
+        # innermost, so that only requests which reach the node count
+        w3.middleware_onion.inject(self.middleware, 'health', layer=0)
+
+    def middleware(self, make_request, w3):
+        def middleware(method, params):
+            try:
+                response = make_request(method, params)
+            except TRANSPORT_ERRORS:
+                self.transport_errors += 1
+                self.down = True
+                raise
+            self.last_ok = time.monotonic()
+            self.down = False
+            return response
+
+        return middleware
+
+    @property
+    def w3(self) -> web3.Web3:
+        """
+        :return: the connection, reconnected first if it is down or has not been heard from in `max_age`
+        """
+        if self.down or time.monotonic() - self.last_ok >= self.max_age:
+            with self._lock:
+                if self.down or time.monotonic() - self.last_ok >= self.max_age:
+                    self._check()
+        return self._w3
+
+    def _check(self):
+        self.checks += 1
+        if not self.down and self._w3.is_connected():
+            self.last_ok = time.monotonic()
+            return
+        self.reconnect()
+
+    def reconnect(self) -> bool:
+        """
+        :return: whether the node answers on the new provider
+        """
+        if self.print is not None:
+            self.print.error('W3 Disconnected! Reconnecting ... ')
+        self._w3.provider = make_provider(self._w3.endpoints)
+        self.reconnects += 1
+        if self._w3.is_connected():
+            self.last_ok = time.monotonic()
+            self.down = False
+            return True
+        self.failed_reconnects += 1
+        # tried again after the next transport error or `max_age`, not on every access
+        self.last_ok = time.monotonic()
+        self.down = False
+        return False
+
+    def summary(self) -> str:
+        return (f'{self.checks} liveness checks, {self.transport_errors} transport errors, '
+                f'{self.reconnects} reconnects ({self.failed_reconnects} failed)')
@@ -44,6 +44,15 @@ def divide_chunks(l: list, n: int) -> list:
     return [chunk for chunk in split_gen(l, n)]
 
 
+def cache_dir() -> str:
+    """
+    Directory for local caches, `evmtools_cache_dir` in .env or `.cache`. Created if missing.
+    """
+    path = os.environ.get('evmtools_cache_dir', '.cache')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def load_json(file: str) -> dict:
     assert os.path.exists(file)
     with open(file, 'r') as f:
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
+import json
 import os
+import time
+
 import dotenv
+import requests
 import web3
 from web3.exceptions import ExtraDataLengthError
 from web3.middleware import geth_poa_middleware
 
 from exceptions.errors import DotenvNotConfigured
+from utils.helpers import cache_dir
+from utils.rpc_cache import RpcCache, construct_rpc_cache_middleware
+from utils.rpc_pool import RpcPool
 
 dotenv.load_dotenv()
 
+# chains known to need the poa middleware, the others are told apart by their genesis block
+POA_CHAIN_IDS = {56, 97, 128, 256, 137, 80001}
+# seconds before a cached handshake is done again
+CHAIN_METADATA_MAX_AGE = 7 * 24 * 3600
+
 
 def is_poa_chain(w3: web3.Web3):
     try:
@@ -18,7 +30,6 @@ def is_poa_chain(w3: web3.Web3):
         return True
     else:
         extra_data = genesis_block['extraData']
-        print(len(extra_data))
         consensus_engine = extra_data[0:4]
         if consensus_engine in (b'\x63\x6c\x69\x71', b'\x69\x62\x66\x74') or len(extra_data) > 64:
             return True
@@ -26,14 +37,123 @@ def is_poa_chain(w3: web3.Web3):
             return False
 
 
-def setup_w3(network: str) -> (web3.Web3, False):
-    endpoint = os.environ.get(f'{network}_http_endpoint')
-    if endpoint is None:
+def chain_metadata_file() -> str:
+    return os.path.join(cache_dir(), 'chains.json')
+
+
+def load_chain_metadata() -> dict:
+    """
+    :return: {endpoint: {'chain_id', 'poa', 'client_version', 'checked'}} of the endpoints connected to before
+    """
+    try:
+        with open(chain_metadata_file(), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_chain_metadata(endpoint: str, metadata: dict):
+    everything = load_chain_metadata()
+    everything[endpoint] = metadata
+    tmp = chain_metadata_file() + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(everything, f, indent=2)
+    os.replace(tmp, chain_metadata_file())
+
+
+def handshake(w3: web3.Web3) -> (dict, None):
+    """
+    :return: chain id, poa flag and client version of the node, None if it can not be reached
+    """
+    if not w3.is_connected():
+        return None
+    chain_id = w3.eth.chain_id
+    try:
+        client_version = w3.client_version
+    except ValueError:
+        client_version = None
+    return {'chain_id': chain_id, 'poa': chain_id in POA_CHAIN_IDS or is_poa_chain(w3),
+            'client_version': client_version, 'checked': time.time()}
+
+
+def construct_chain_id_middleware(chain_id: int):
+    """
+    Answer eth_chainId locally, the chain behind an endpoint does not change.
+    """
+
+    def chain_id_middleware(make_request, w3):
+        def middleware(method, params):
+            if method == 'eth_chainId':
+                return {'jsonrpc': '2.0', 'id': 0, 'result': hex(chain_id)}
+            return make_request(method, params)
+
+        return middleware
+
+    return chain_id_middleware
+
+
+def make_provider(endpoints: list[str]) -> (web3.HTTPProvider, RpcPool):
+    """
+    :return: a provider with new http sessions, a RpcPool for several endpoints
+    """
+    if len(endpoints) == 1:
+        return web3.HTTPProvider(endpoints[0], session=requests.Session())
+    return RpcPool(endpoints)
+
+
+def connect(endpoint: (str, list), cache: (bool, RpcCache) = False, refresh: bool = False) -> (web3.Web3, False):
+    """
+    The one place web3 connections are made. Chain id, poa flag and client version are cached per
+    endpoint in chains.json in the cache directory, so after the first run there is no handshake:
+    a dead endpoint shows up on the first real request instead. Cached entries are checked again
+    after CHAIN_METADATA_MAX_AGE.
+    :param endpoint: http endpoint, or several endpoints of the same chain to use as a RpcPool
+    :param cache: serve immutable rpc results (old blocks, mined receipts, state at final blocks) from
+    disk. True for the default RpcCache, or a RpcCache to share one
+    :param refresh: do the handshake even if the endpoint is cached
+    :return: web3 instance, or False if the handshake failed
+    """
+    endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint)
+    w3 = web3.Web3(make_provider(endpoints))
+    w3.endpoints = endpoints
+    cached = {} if refresh else load_chain_metadata()
+    # any endpoint of a pool will do, they serve the same chain
+    metadata = next((cached[url] for url in endpoints
+                     if url in cached and time.time() - cached[url].get('checked', 0) <= CHAIN_METADATA_MAX_AGE),
+                    None)
+    if metadata is None:
+        metadata = handshake(w3)
+        if metadata is None:
+            return False
+        for url in endpoints:
+            save_chain_metadata(url, metadata)
+    w3.chain_metadata = metadata
+    if metadata['poa']:
+        w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    if cache:
+        # innermost, so that it stores the raw responses
+        w3.middleware_onion.inject(construct_rpc_cache_middleware(RpcCache() if cache is True else cache,
+                                                                  chain_id=metadata['chain_id']),
+                                   'rpc_cache', layer=0)
+    w3.middleware_onion.inject(construct_chain_id_middleware(metadata['chain_id']), 'chain_id', layer=0)
+    return w3
+
+
+def network_endpoints(network: str) -> list[str]:
+    """
+    :return: the http endpoints of a network, from a comma separated `{network}_http_endpoints` or
+    `{network}_http_endpoint` in .env
+    """
+    value = os.environ.get(f'{network}_http_endpoints') or os.environ.get(f'{network}_http_endpoint')
+    if value is None:
         raise DotenvNotConfigured("You need to setup your `.env` file first! See docs.")
-    w3 = web3.Web3(web3.HTTPProvider(endpoint))
-    if w3.is_connected():
-        if is_poa_chain(w3):
-            w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        return w3
-    return False
+    return [url.strip() for url in value.split(',') if url.strip()]
+
 
+def setup_w3(network: str, cache: (bool, RpcCache) = False) -> (web3.Web3, False):
+    """
+    :param network: reads `{network}_http_endpoints` or `{network}_http_endpoint` from .env, several
+    endpoints are used as a pool
+    :param cache: see connect
+    """
+    return connect(network_endpoints(network), cache)
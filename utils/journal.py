@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+
+def read_jsonl(file: str):
+    """
+    :return: generator over the objects of a json lines file, a torn last line is skipped
+    """
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+class Journal:
+    def __init__(self, output_file: str, checkpoint_file: str = None, resume: bool = False,
+                 sync_interval: float = 5.0):
+        """
+        Append only json lines output with a checkpoint of completed keys. Records go to the journal
+        right away, completed keys are only written to the checkpoint after the journal has been
+        fsynced, so a key in the checkpoint always has all of its records on disk.
+        :param output_file: json lines file
+        :param checkpoint_file: completed keys, one per line, defaults to output_file + '.done'
+        :param resume: keep existing output and checkpoint, otherwise start over
+        :param sync_interval: seconds between fsyncs
+        """
+        self.output_file = output_file
+        self.checkpoint_file = checkpoint_file or output_file + '.done'
+        self.sync_interval = sync_interval
+        self.done: set[str] = set()
+        if resume and os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r') as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        mode = 'a' if resume else 'w'
+        if resume:
+            self._drop_torn_line()
+        self._out = open(self.output_file, mode)
+        self._checkpoint = open(self.checkpoint_file, mode)
+        self._pending: list[str] = []
+        self._last_sync = time.monotonic()
+
+    def _drop_torn_line(self):
+        """
+        Truncate the output after its last complete line, so that a record cut short by a crash is
+        not merged with the next one.
+        """
+        if not os.path.exists(self.output_file):
+            return
+        with open(self.output_file, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b'\n')
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != end:
+                f.truncate(position)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def write(self, obj: dict):
+        self._out.write(json.dumps(obj) + '\n')
+
+    def complete(self, key: str):
+        """
+        Mark `key` as done, it is checkpointed at the next sync.
+        """
+        self.done.add(key)
+        self._pending.append(key)
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        if self._pending:
+            self._checkpoint.write(''.join(key + '\n' for key in self._pending))
+            self._checkpoint.flush()
+            os.fsync(self._checkpoint.fileno())
+            self._pending = []
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._out.close()
+        self._checkpoint.close()
@@ -0,0 +1,125 @@
+import asyncio
+import itertools
+import json
+
+from exceptions.errors import JsonRpcError
+from utils.ahttp import AsyncHttpClient
+
+
+class AsyncJsonRpcClient:
+    def __init__(self, endpoint: str, window: float = 0.002, max_batch: int = 100):
+        """
+        Async JSON-RPC client on top of AsyncHttpClient. Calls made within `window` seconds of each
+        other go out as one batch request, and a call identical to one still in flight waits for
+        that one instead of being sent again.
+        :param endpoint: node http endpoint
+        :param window: seconds to wait for more calls before sending a batch
+        :param max_batch: calls per batch request, a full batch is sent right away
+        """
+        self.endpoint = endpoint
+        self.window = window
+        self.max_batch = max_batch
+        self.http: (AsyncHttpClient, None) = None
+        # http requests sent, json-rpc calls in them, and calls answered by one already in flight
+        self.requests: int = 0
+        self.calls: int = 0
+        self.coalesced: int = 0
+        self._ids = itertools.count(1)
+        self._queue: list[tuple[str, dict, asyncio.Future]] = []
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._timer: (asyncio.TimerHandle, None) = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def __ainit__(self, http: AsyncHttpClient = None):
+        """
+        :param http: share the session of an existing client, otherwise one is created
+        """
+        if http is None:
+            http = AsyncHttpClient(_headers={'content-type': 'application/json'})
+            await http.__ainit__()
+        self.http = http
+
+    async def call(self, method: str, params: list = None):
+        """
+        :return: the result of the call
+        :raises JsonRpcError: if the node returned an error for it, or the request failed
+        """
+        params = [] if params is None else params
+        key = method + json.dumps(params, sort_keys=True, separators=(',', ':'))
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._inflight[key] = future
+            request = {'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params}
+            self._queue.append((key, request, future))
+            if len(self._queue) >= self.max_batch:
+                self._send_queue()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._send_queue)
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the call for the others waiting on it
+        return await asyncio.shield(future)
+
+    def _send_queue(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, dict, asyncio.Future]]):
+        self.requests += 1
+        self.calls += len(batch)
+        try:
+            status, resp = await self.http.request('post', path=self.endpoint,
+                                                   data=[request for _, request, _ in batch])
+        except Exception as err:
+            status, resp = 0, repr(err)
+        if status == 413 and len(batch) > 1:
+            # request body over the node's limit, send it in halves. Only the halves are counted
+            self.requests -= 1
+            self.calls -= len(batch)
+            half = len(batch) // 2
+            await asyncio.gather(self._send(batch[:half]), self._send(batch[half:]))
+            return
+        for key, _, _ in batch:
+            self._inflight.pop(key, None)
+        if status != 200 or not isinstance(resp, list):
+            # transport failure, or one error object for the whole batch
+            err = JsonRpcError(f'{self.endpoint} returned {status}: {str(resp)[:200]}')
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        responses = {r.get('id'): r for r in resp if isinstance(r, dict)}
+        for _, request, future in batch:
+            if future.done():
+                continue
+            response = responses.get(request['id'])
+            if response is None:
+                future.set_exception(JsonRpcError(f'No response to {request["method"]}'))
+            elif response.get('error') is not None:
+                error = response['error']
+                if isinstance(error, dict):
+                    future.set_exception(JsonRpcError(error.get('message', ''), error.get('code'), error.get('data')))
+                else:
+                    future.set_exception(JsonRpcError(str(error)))
+            else:
+                future.set_result(response.get('result'))
+
+    async def eth_call(self, to: str, data: bytes, block: (str, int) = 'latest') -> bytes:
+        block = hex(block) if isinstance(block, int) else block
+        result = await self.call('eth_call', [{'to': to, 'data': '0x' + bytes(data).hex()}, block])
+        return bytes.fromhex(result[2:])
+
+    async def block_number(self) -> int:
+        return int(await self.call('eth_blockNumber'), 16)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
@@ -0,0 +1,219 @@
+import asyncio
+import time
+
+from eth_utils import to_checksum_address
+
+from exceptions.errors import IndexerError, JsonRpcError
+from utils.jsonrpc import AsyncJsonRpcClient
+from utils.multicall import Multicall
+from utils.ratelimit import backoff_delay
+from utils.tokentx import TokenMeta
+from utils.tx_cache import TokenTxCache
+
+# keccak('Transfer(address,address,uint256)'), ERC721 shares it but has a 4th (indexed) topic
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+# what nodes say when a getLogs query matches too many logs or spans too many blocks
+TOO_LARGE_ERRORS = ('more than', 'too many', 'exceed', 'limited to', 'range', 'too large', 'response size',
+                    'timeout', 'timed out')
+
+
+def address_topic(address: str) -> str:
+    return '0x' + '0' * 24 + address.lower()[2:]
+
+
+def is_too_large(err: Exception) -> bool:
+    """
+    :return: True if a getLogs error means the query should be split into smaller block ranges
+    """
+    message = str(err).lower()
+    if 'rate' in message:
+        # rate limited, back off instead
+        return False
+    return any(s in message for s in TOO_LARGE_ERRORS)
+
+
+class LogScanner:
+    def __init__(self, rpc: AsyncJsonRpcClient, chunk_size: int = 5000, workers: int = 4, retries: int = 5):
+        """
+        eth_getLogs over long block ranges, on nodes that cap the range or the result size of a query.
+        :param rpc: json-rpc client of the node
+        :param chunk_size: blocks per getLogs query, shrinks when the node refuses a range
+        :param workers: getLogs queries in flight
+        :param retries: attempts per query on errors other than range too large
+        """
+        self.rpc = rpc
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        # getLogs queries sent, including refused ones
+        self.rpc_calls: int = 0
+        self._slots = asyncio.Semaphore(workers)
+
+    async def get_logs(self, from_block: int, to_block: int, topics: list, address: str = None) -> list:
+        """
+        getLogs over [from_block, to_block], halving the range for as long as the node says it is
+        too large.
+        :param address: only the logs of this contract
+        :raises IndexerError: on other errors that persist for `retries` attempts
+        """
+        err = None
+        for attempt in range(self.retries):
+            try:
+                log_filter = {'fromBlock': hex(from_block), 'toBlock': hex(to_block), 'topics': topics}
+                if address is not None:
+                    log_filter['address'] = address
+                async with self._slots:
+                    self.rpc_calls += 1
+                    return await self.rpc.call('eth_getLogs', [log_filter])
+            except JsonRpcError as e:
+                err = e
+                if is_too_large(err) and to_block > from_block:
+                    # later chunks start out at the size that worked
+                    self.chunk_size = max(1, min(self.chunk_size, (to_block - from_block + 1) // 2))
+                    mid = (from_block + to_block) // 2
+                    left, right = await asyncio.gather(self.get_logs(from_block, mid, topics, address),
+                                                       self.get_logs(mid + 1, to_block, topics, address))
+                    return left + right
+                await asyncio.sleep(backoff_delay(attempt))
+        raise IndexerError(f'getLogs {from_block}-{to_block} failed {self.retries} times: {err}')
+
+
+class TransferLogScanner(LogScanner):
+    def __init__(self, rpc: AsyncJsonRpcClient, multicall: Multicall, network: str, from_block: int = 0,
+                 chunk_size: int = 5000, workers: int = 4, max_holders: int = 100, retries: int = 5,
+                 tx_cache: (TokenTxCache, None) = None, window: float = 0.05, checkpoint_interval: float = 30.0):
+        """
+        Token discovery from ERC20 Transfer logs, an indexer free alternative to the tokentx APIs that
+        works on any node. fetch_tokens() calls made within `window` of each other are scanned
+        together, with their holders as topic filters, so one getLogs covers up to `max_holders`
+        accounts. Block ranges are scanned in parallel and halved whenever the node refuses a query
+        as too large.
+        :param rpc: json-rpc client of the node
+        :param multicall: used to read name, symbol and decimals of the tokens found
+        :param network: network name, for the tx cache
+        :param from_block: first block to scan, ie the chain's first token deployment
+        :param chunk_size: blocks per getLogs query, shrinks when the node refuses a range
+        :param workers: getLogs queries in flight
+        :param max_holders: holders per topic filter
+        :param retries: attempts per query on errors other than range too large
+        :param tx_cache: progress of long scans is checkpointed here every `checkpoint_interval` seconds
+        :param window: seconds to wait for more holders before starting a scan
+        """
+        super().__init__(rpc, chunk_size, workers, retries)
+        self.multicall = multicall
+        self.network = network
+        self.from_block = from_block
+        self.max_holders = max_holders
+        self.tx_cache = tx_cache
+        self.window = window
+        self.checkpoint_interval = checkpoint_interval
+        self.metadata: dict[str, TokenMeta] = {}
+        self._pending: list[tuple[str, int, asyncio.Future]] = []
+        self._flush: (asyncio.Task, None) = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def fetch_tokens(self, address: str, startblock: int = 0) -> (dict, int):
+        """
+        Same interface as HecoScanner.fetch_tokens.
+        :return: {contract: TokenMeta} of the tokens the address sent or received since startblock,
+        last block scanned
+        :raises IndexerError: if the node keeps failing
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((address.lower(), max(startblock, self.from_block), future))
+        if self._flush is None:
+            self._flush = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush = None
+        pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.max_holders):
+            task = asyncio.create_task(self._run_batch(pending[i:i + self.max_holders]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: list[tuple[str, int, asyncio.Future]]):
+        try:
+            holders = sorted({holder for holder, _, _ in batch})
+            start = min(startblock for _, startblock, _ in batch)
+            end = await self.rpc.block_number()
+            found = await self.scan(holders, start, end)
+            tokens = await self.token_metadata(set().union(*found.values()))
+        except Exception as err:
+            if not isinstance(err, IndexerError):
+                err = IndexerError(f'Log scan failed: {err!r}')
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for holder, _, future in batch:
+            if not future.done():
+                future.set_result(({contract: tokens[contract] for contract in found[holder]}, end))
+
+    async def scan(self, holders: list[str], start: int, end: int) -> dict[str, set]:
+        """
+        :param holders: lowercase addresses, at most a few hundred, nodes cap the topic list size
+        :return: {holder: {contract, ...}} of every ERC20 Transfer from or to the holders in
+        [start, end]
+        """
+        holder_topics = [address_topic(holder) for holder in holders]
+        found: dict[str, set] = {holder: set() for holder in holders}
+        # chunks are handed out in block order, `done` tracks which finished for the checkpoint
+        chunks: list[int] = []
+        done: list[bool] = []
+        state = {'next': start, 'watermark': 0, 'checkpoint': time.monotonic()}
+
+        def record(logs: list, position: int):
+            for log in logs:
+                topics = log['topics']
+                if len(topics) != 3:
+                    continue
+                holder = '0x' + topics[position][-40:].lower()
+                if holder in found:
+                    found[holder].add(log['address'].lower())
+
+        async def worker():
+            while state['next'] <= end:
+                from_block = state['next']
+                to_block = min(end, from_block + self.chunk_size - 1)
+                state['next'] = to_block + 1
+                i = len(chunks)
+                chunks.append(to_block)
+                done.append(False)
+                sent, received = await asyncio.gather(
+                    self.get_logs(from_block, to_block, [TRANSFER_TOPIC, holder_topics]),
+                    self.get_logs(from_block, to_block, [TRANSFER_TOPIC, None, holder_topics]))
+                record(sent, 1)
+                record(received, 2)
+                done[i] = True
+                while state['watermark'] < len(done) and done[state['watermark']]:
+                    state['watermark'] += 1
+                if self.tx_cache is not None and state['watermark'] and \
+                        time.monotonic() - state['checkpoint'] >= self.checkpoint_interval:
+                    state['checkpoint'] = time.monotonic()
+                    await self.checkpoint(found, chunks[state['watermark'] - 1])
+
+        await asyncio.gather(*[worker() for _ in range(self.workers)])
+        return found
+
+    async def checkpoint(self, found: dict[str, set], last_block: int):
+        """
+        Save what was found up to `last_block` in the tx cache, so an interrupted scan resumes there.
+        """
+        tokens = await self.token_metadata(set().union(*found.values()))
+        for holder, contracts in found.items():
+            self.tx_cache.update(self.network, holder, [tokens[contract] for contract in contracts], last_block)
+
+    async def token_metadata(self, contracts: set[str]) -> dict[str, TokenMeta]:
+        """
+        :return: {contract: TokenMeta}, metadata is read once per contract with multicall
+        """
+        missing = [contract for contract in contracts if contract not in self.metadata]
+        if missing:
+            results = await self.multicall.token_metadata([to_checksum_address(contract) for contract in missing])
+            for contract, (name, symbol, decimals) in zip(missing, results):
+                self.metadata[contract] = TokenMeta(to_checksum_address(contract), name, symbol,
+                                                    None if decimals is None else str(decimals))
+        return {contract: self.metadata[contract] for contract in contracts}
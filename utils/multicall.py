@@ -0,0 +1,115 @@
+import asyncio
+
+import eth_abi
+from eth_abi.exceptions import DecodingError
+from eth_typing import ChecksumAddress
+from eth_utils import to_checksum_address
+
+from exceptions.errors import JsonRpcError
+from utils.jsonrpc import AsyncJsonRpcClient
+
+# same address on every chain it is deployed to
+MULTICALL3_ADDRESS: ChecksumAddress = to_checksum_address('0xcA11bde05977b3631167028862bE2a173976CA11')
+AGGREGATE3_SELECTOR = bytes.fromhex('82ad56cb')
+BALANCE_OF_SELECTOR = bytes.fromhex('70a08231')
+NAME_SELECTOR = bytes.fromhex('06fdde03')
+SYMBOL_SELECTOR = bytes.fromhex('95d89b41')
+DECIMALS_SELECTOR = bytes.fromhex('313ce567')
+
+
+def balance_of_calldata(holder: str) -> bytes:
+    return BALANCE_OF_SELECTOR + bytes(12) + bytes.fromhex(holder[2:] if holder.startswith('0x') else holder)
+
+
+def decode_uint(success: bool, return_data: bytes) -> (int, None):
+    """
+    :return: the first uint256 of a call result, or None if the call failed or returned garbage
+    """
+    if not success or len(return_data) < 32:
+        return None
+    return int.from_bytes(return_data[:32], 'big')
+
+
+def decode_string(success: bool, return_data: bytes) -> (str, None):
+    """
+    :return: an abi encoded string result, or a bytes32 one as returned by some old tokens (MKR),
+    None if the call failed or returned garbage
+    """
+    if not success:
+        return None
+    if len(return_data) == 32:
+        return return_data.rstrip(b'\x00').decode('utf-8', 'replace')
+    if len(return_data) < 64:
+        return None
+    offset = int.from_bytes(return_data[:32], 'big')
+    if offset + 32 > len(return_data):
+        return None
+    length = int.from_bytes(return_data[offset:offset + 32], 'big')
+    if offset + 32 + length > len(return_data):
+        return None
+    return return_data[offset + 32:offset + 32 + length].decode('utf-8', 'replace')
+
+
+class Multicall:
+    def __init__(self, rpc: AsyncJsonRpcClient, batch_size: int = 500, address: ChecksumAddress = MULTICALL3_ADDRESS):
+        """
+        Batch many read only calls into Multicall3 aggregate3 eth_calls.
+        :param rpc: json-rpc client, concurrent batches share its batch requests
+        :param batch_size: calls per eth_call, batches the node fails to execute are split in half and
+        retried, transport errors are raised
+        :param address: Multicall3 deployment
+        """
+        self.rpc = rpc
+        self.batch_size = batch_size
+        self.address = address
+        # eth_calls actually sent, including the ones that failed and got split
+        self.rpc_calls: int = 0
+
+    async def _aggregate3(self, calls: list[tuple[str, bytes]], block: (str, int)) -> list[tuple[bool, bytes]]:
+        self.rpc_calls += 1
+        data = AGGREGATE3_SELECTOR + eth_abi.encode(['(address,bool,bytes)[]'],
+                                                    [[(target, True, calldata) for target, calldata in calls]])
+        try:
+            return list(eth_abi.decode(['(bool,bytes)[]'], await self.rpc.eth_call(self.address, data, block))[0])
+        except (JsonRpcError, DecodingError) as err:
+            # a node that is down or unreachable says nothing about the calls, let the caller know
+            if isinstance(err, JsonRpcError) and err.code is None:
+                raise
+            # out of gas, response too large, or one call that breaks the whole batch
+            if len(calls) == 1:
+                return [(False, b'')]
+            half = len(calls) // 2
+            left, right = await asyncio.gather(self._aggregate3(calls[:half], block),
+                                               self._aggregate3(calls[half:], block))
+            return left + right
+
+    async def aggregate3(self, calls: list[tuple[str, bytes]],
+                         block: (str, int) = 'latest') -> list[tuple[bool, bytes]]:
+        """
+        :param calls: [(target, calldata), ...], any length
+        :param block: block number or tag the calls are made at, a number keeps several batches consistent
+        :return: [(success, return data), ...] in the same order, every call is allowed to fail
+        :raises JsonRpcError: without a code if the node could not be reached
+        """
+        batches = await asyncio.gather(*[self._aggregate3(calls[i:i + self.batch_size], block)
+                                         for i in range(0, len(calls), self.batch_size)])
+        return [result for batch in batches for result in batch]
+
+    async def balances(self, pairs: list[tuple[str, str]]) -> list[(int, None)]:
+        """
+        :param pairs: [(token, holder), ...]
+        :return: balanceOf for each pair, None for tokens that reverted or returned nothing
+        """
+        calls = [(token, balance_of_calldata(holder)) for token, holder in pairs]
+        return [decode_uint(success, data) for success, data in await self.aggregate3(calls)]
+
+    async def token_metadata(self, tokens: list[str]) -> list[tuple[(str, None), (str, None), (int, None)]]:
+        """
+        :param tokens: token contracts
+        :return: (name, symbol, decimals) for each token, None for the fields it does not implement
+        """
+        calls = [(token, selector) for token in tokens for selector in (NAME_SELECTOR, SYMBOL_SELECTOR,
+                                                                         DECIMALS_SELECTOR)]
+        results = await self.aggregate3(calls)
+        return [(decode_string(*results[i]), decode_string(*results[i + 1]), decode_uint(*results[i + 2]))
+                for i in range(0, len(results), 3)]
@@ -0,0 +1,197 @@
+import asyncio
+
+from eth_utils import to_checksum_address
+
+from exceptions.errors import JsonRpcError
+from utils.log_scanner import LogScanner
+from utils.reserves import ReservesEngine, get_amount_out
+
+# keccak('PairCreated(address,address,address,uint256)'), token0 and token1 indexed, the pair in data
+PAIR_CREATED_TOPIC = '0x0d3648bd0f6ba80134a33ba9275ac585d9d315f0ad8355cddefde31afa28d0e9'
+# only the next to last hop is pruned, longer paths would expand every pair of the hubs
+MAX_HOPS = 3
+
+
+class Route:
+    __slots__ = ('path', 'amounts', 'value')
+
+    def __init__(self, path: list[str], amounts: list[int], value: float):
+        """
+        A swap path as the router's getAmountsOut takes it, with what getAmountsOut returns for it.
+        :param path: checksum token addresses, from the token sold to the target
+        :param amounts: raw amount at each token of the path
+        :param value: the last amount in target token units
+        """
+        self.path = path
+        self.amounts = amounts
+        self.value = value
+
+
+class PairGraph:
+    def __init__(self, engine: ReservesEngine, logs: LogScanner, from_block: (int, None) = 0, max_paths: int = 256):
+        """
+        Local graph of the pairs of a uniswap v2 factory, built from its PairCreated events and stored
+        in the engine's PairCache. sync() indexes the events since the last sync, routes() searches the
+        graph for the best path of up to a few hops to a target token. All candidate paths are scored
+        with reserves read in one multicall, nothing is asked per candidate.
+        :param engine: reserves, fee and pair store of the factory
+        :param logs: getLogs on the same node
+        :param from_block: where the first sync starts, the block the factory was deployed at. None
+        to look it up with deployment_block
+        :param max_paths: candidate paths per token, shorter ones are found first
+        """
+        self.engine = engine
+        self.logs = logs
+        self.from_block = from_block
+        self.max_paths = max_paths
+        # {token: {neighbour token: pair}}, lowercase
+        self.adjacency: dict[str, dict[str, str]] = {}
+        self.loaded: bool = False
+        # tokens paired with any of a set of targets, per targets
+        self._near: dict[frozenset, set[str]] = {}
+
+    def _add(self, token0: str, token1: str, pair: str):
+        self.adjacency.setdefault(token0, {})[token1] = pair
+        self.adjacency.setdefault(token1, {})[token0] = pair
+
+    def load(self):
+        """
+        Read the stored pairs into the graph.
+        """
+        for token0, token1, pair in self.engine.pair_cache.existing(self.engine.network, self.engine.factory):
+            self._add(token0, token1, pair)
+        self.loaded = True
+        self._near.clear()
+
+    async def sync(self, to_block: int = None) -> int:
+        """
+        Index the PairCreated events after the last sync. Each round of parallel getLogs queries is
+        stored before the next one starts, so an interrupted sync resumes where it stopped.
+        :param to_block: defaults to the head
+        :return: pairs added
+        """
+        if not self.loaded:
+            self.load()
+        network, factory = self.engine.network, self.engine.factory
+        last_block = self.engine.pair_cache.last_synced(network, factory)
+        end = await self.logs.rpc.block_number() if to_block is None else to_block
+        if last_block is not None:
+            start = last_block + 1
+        elif self.from_block is None:
+            start = await self.deployment_block(end)
+        else:
+            start = self.from_block
+        added = 0
+        while start <= end:
+            ranges = []
+            for _ in range(self.logs.workers):
+                if start > end:
+                    break
+                ranges.append((start, min(end, start + self.logs.chunk_size - 1)))
+                start = ranges[-1][1] + 1
+            results = await asyncio.gather(*[self.logs.get_logs(from_block, to_block, [PAIR_CREATED_TOPIC], factory)
+                                             for from_block, to_block in ranges])
+            pairs = []
+            for log in (log for logs in results for log in logs):
+                topics = log['topics']
+                if len(topics) != 3 or len(log['data']) < 66:
+                    continue
+                pair = ('0x' + topics[1][-40:].lower(), '0x' + topics[2][-40:].lower(),
+                        '0x' + log['data'][26:66].lower())
+                pairs.append(pair)
+                self._add(*pair)
+            self.engine.pair_cache.add_created(network, factory, pairs, ranges[-1][1])
+            added += len(pairs)
+        if added:
+            self._near.clear()
+        return added
+
+    async def deployment_block(self, head: int) -> int:
+        """
+        First block the factory has code at, by bisecting eth_getCode over about 25 calls. Only
+        asked before the first sync, the result is stored with the synced pairs.
+        :return: the block, 0 if the node does not keep the old state
+        """
+        low, high = 0, head
+        try:
+            while low < high:
+                middle = (low + high) // 2
+                if await self.logs.rpc.call('eth_getCode', [self.engine.factory, hex(middle)]) not in (None, '0x'):
+                    high = middle
+                else:
+                    low = middle + 1
+        except JsonRpcError:
+            return 0
+        return low
+
+    def paths(self, token: str, targets: set[str], max_hops: int = 3) -> list[list[str]]:
+        """
+        Breadth first search for paths from `token` to any of `targets`. The next to last hop only
+        goes to tokens paired with a target, so hubs with thousands of pairs are not expanded blindly.
+        :param targets: lowercase addresses
+        :param max_hops: pairs per path, at most MAX_HOPS
+        :return: up to max_paths lowercase paths of at most `max_hops` pairs, without repeated tokens,
+        shortest first
+        """
+        max_hops = min(max_hops, MAX_HOPS)
+        key = frozenset(targets)
+        if key not in self._near:
+            self._near[key] = set(targets).union(*[self.adjacency.get(target, {}) for target in targets])
+        near = self._near[key]
+        found = []
+        frontier = [[token.lower()]]
+        for hop in range(max_hops):
+            last_hop = hop == max_hops - 1
+            extended = []
+            for path in frontier:
+                neighbours = self.adjacency.get(path[-1], {})
+                if last_hop:
+                    candidates = [target for target in targets if target in neighbours]
+                elif hop == max_hops - 2:
+                    # iterate the smaller side of the intersection
+                    candidates = [candidate for candidate in near if candidate in neighbours] \
+                        if len(near) < len(neighbours) else [neighbour for neighbour in neighbours if neighbour in near]
+                else:
+                    candidates = neighbours
+                for neighbour in candidates:
+                    if neighbour in path:
+                        continue
+                    if neighbour in targets:
+                        found.append(path + [neighbour])
+                        if len(found) >= self.max_paths:
+                            return found
+                    elif not last_hop:
+                        extended.append(path + [neighbour])
+            frontier = extended
+        return found
+
+    async def routes(self, items: list[tuple[str, int]], targets: list[tuple[str, int]], max_hops: int = 3,
+                     block: int = None) -> list[(Route, None)]:
+        """
+        Best route of each item to one of the targets.
+        :param items: [(token, raw amount), ...]
+        :param targets: [(token, decimals), ...] of tokens worth one unit each, ie USD stables
+        :param max_hops: pairs per path, at most MAX_HOPS
+        :param block: block the reserves are read at, defaults to the head
+        :return: the Route with the highest value per item, None where no path has liquidity
+        """
+        if not self.loaded:
+            self.load()
+        decimals = {token.lower(): places for token, places in targets}
+        candidates = [self.paths(token, set(decimals), max_hops) if amount > 0 else [] for token, amount in items]
+        pairs = {self.adjacency[a][b] for paths in candidates for path in paths for a, b in zip(path, path[1:])}
+        reserves = await self.engine.reserves(list(pairs), block)
+        best_routes = []
+        for (_, amount), paths in zip(items, candidates):
+            best = None
+            for path in paths:
+                amounts = [amount]
+                for a, b in zip(path, path[1:]):
+                    pair_reserves = reserves.get(self.adjacency[a][b], (0, 0))
+                    reserve_in, reserve_out = pair_reserves if a < b else pair_reserves[::-1]
+                    amounts.append(get_amount_out(amounts[-1], reserve_in, reserve_out, self.engine.fee_bps))
+                value = amounts[-1] / 10 ** decimals[path[-1]]
+                if value > 0 and (best is None or value > best.value):
+                    best = Route([to_checksum_address(token) for token in path], amounts, value)
+            best_routes.append(best)
+        return best_routes
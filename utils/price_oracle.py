@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+import requests
+import web3
+from eth_utils import to_checksum_address
+from web3.exceptions import Web3Exception
+
+from exceptions.errors import PriceUnavailable
+from utils.helpers import cache_dir
+from utils.reserves import GET_PAIR_SELECTOR, GET_RESERVES_SELECTOR, ZERO_ADDRESS
+
+# network: (explorer api, stats action, result field, .env key of the api key)
+EXPLORER_PRICE_APIS = {
+    'heco': ('https://api.hecoinfo.com/api', 'price', 'coinusd', None),
+    'bsc': ('https://api.bscscan.com/api', 'bnbprice', 'ethusd', 'bscan_api_key'),
+    'ethereum': ('https://api.etherscan.io/api', 'ethprice', 'ethusd', 'etherscan_api_key'),
+    'polygon': ('https://api.polygonscan.com/api', 'maticprice', 'maticusd', 'polygonscan_api_key'),
+}
+# network: (v2 factory, wrapped native, USD stable, stable decimals) read when the explorer is down
+ONCHAIN_PRICE_POOLS = {
+    'heco': ('0xb0b670fc1f7724119963018db0bfa86adb22d941', '0x5545153ccfca01fbd7dd11c0b23ba694d9509a6f',
+             '0xa71edc38d189767582c38a3145b5873052c3e47a', 18),
+    'bsc': ('0xca143ce32fe78f1f7019d7d551a6402fc5350c73', '0xbb4CdB9CBd36B01bD1cBaEBF2De08d9173bc095c',
+            '0x55d398326f99059fF775485246999027B3197955', 18),
+    'ethereum': ('0x5C69bEe701ef814a2B6a3EDD4B1652CB9cc5aA6f', '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2',
+                 '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48', 6),
+    'polygon': ('0x5757371414417b8C6CAad45bAeF941aBc7d3Ab32', '0x0d500B1d8E8eF31E21C99d1Db9A6444d3ADf1270',
+                '0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174', 6),
+}
+
+
+class NativePrice:
+    __slots__ = ('price', 'time', 'source')
+
+    def __init__(self, price: float, time_: float, source: str):
+        """
+        :param price: USD per native coin
+        :param time_: unix time it was fetched
+        :param source: 'explorer' or 'onchain'
+        """
+        self.price = price
+        self.time = time_
+        self.source = source
+
+    @property
+    def age(self) -> float:
+        """
+        :return: seconds since the price was fetched
+        """
+        return time.time() - self.time
+
+
+class NativePriceOracle:
+    def __init__(self, network: str, ttl: float = 300.0, timeout: float = 5.0, pool: tuple = None):
+        """
+        USD price of a network's native coin. Prices are shared between tools and runs through
+        prices.json in the cache directory and only fetched again after `ttl`. The explorer stats api
+        is asked first, the reserves of the stable / wrapped native pair on chain if it is slow or
+        down, and a stale cached price is better than none.
+        :param network: key of EXPLORER_PRICE_APIS and ONCHAIN_PRICE_POOLS
+        :param ttl: seconds a price is used before it is fetched again
+        :param timeout: seconds to wait for the explorer
+        :param pool: (factory, wrapped native, stable, stable decimals), defaults to the network's
+        entry in ONCHAIN_PRICE_POOLS
+        """
+        self.network = network
+        self.ttl = ttl
+        self.timeout = timeout
+        self.pool = pool or ONCHAIN_PRICE_POOLS.get(network)
+
+    @staticmethod
+    def cache_file() -> str:
+        return os.path.join(cache_dir(), 'prices.json')
+
+    def cached(self) -> (NativePrice, None):
+        try:
+            with open(self.cache_file(), 'r') as f:
+                entry = json.load(f).get(self.network)
+        except (OSError, ValueError):
+            return None
+        if not entry:
+            return None
+        return NativePrice(entry['price'], entry['time'], entry['source'])
+
+    def save(self, price: NativePrice):
+        try:
+            with open(self.cache_file(), 'r') as f:
+                everything = json.load(f)
+        except (OSError, ValueError):
+            everything = {}
+        everything[self.network] = {'price': price.price, 'time': price.time, 'source': price.source}
+        tmp = f'{self.cache_file()}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(everything, f, indent=2)
+        os.replace(tmp, self.cache_file())
+
+    def from_explorer(self) -> (float, None):
+        """
+        :return: the explorer's price, None if there is no api for the network or it failed
+        """
+        if self.network not in EXPLORER_PRICE_APIS:
+            return None
+        url, action, field, key_name = EXPLORER_PRICE_APIS[self.network]
+        params = {'module': 'stats', 'action': action}
+        if key_name and os.environ.get(key_name):
+            params['apikey'] = os.environ.get(key_name)
+        try:
+            response = requests.get(url, params=params, timeout=self.timeout)
+            price = float(response.json()['result'][field])
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return None
+        return price if price > 0 else None
+
+    def from_chain(self, w3: web3.Web3) -> (float, None):
+        """
+        :return: the marginal price of the stable / wrapped native pair, None without a pool or liquidity
+        """
+        if self.pool is None or w3 is None:
+            return None
+        factory, wrapped, stable, stable_decimals = self.pool
+        wrapped, stable = wrapped.lower(), stable.lower()
+        try:
+            data = w3.eth.call({'to': to_checksum_address(factory),
+                                'data': GET_PAIR_SELECTOR + bytes(12) + bytes.fromhex(wrapped[2:]) + bytes(12) +
+                                bytes.fromhex(stable[2:])})
+            pair = '0x' + bytes(data)[12:32].hex()
+            if pair == ZERO_ADDRESS:
+                return None
+            data = bytes(w3.eth.call({'to': to_checksum_address(pair), 'data': GET_RESERVES_SELECTOR}))
+        except (requests.RequestException, OSError, ValueError, Web3Exception):
+            return None
+        if len(data) < 64:
+            return None
+        reserve0, reserve1 = int.from_bytes(data[:32], 'big'), int.from_bytes(data[32:64], 'big')
+        reserve_wrapped, reserve_stable = (reserve0, reserve1) if wrapped < stable else (reserve1, reserve0)
+        if not reserve_wrapped or not reserve_stable:
+            return None
+        return (reserve_stable / 10 ** stable_decimals) / (reserve_wrapped / 10 ** 18)
+
+    def price(self, w3: web3.Web3 = None, refresh: bool = False) -> NativePrice:
+        """
+        :param w3: connection to the network, for the on chain fallback
+        :param refresh: ignore a cached price that is still fresh
+        :return: the cached price if younger than `ttl`, otherwise a new one
+        :raises PriceUnavailable: if neither source answers and nothing is cached
+        """
+        cached = self.cached()
+        if cached is not None and cached.age < self.ttl and not refresh:
+            return cached
+        for source, fetch in (('explorer', self.from_explorer), ('onchain', lambda: self.from_chain(w3))):
+            value = fetch()
+            if value is not None:
+                price = NativePrice(value, time.time(), source)
+                self.save(price)
+                return price
+        if cached is not None:
+            return cached
+        raise PriceUnavailable(f'No {self.network} native price from the explorer or on chain')
@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+import random
+import time
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Full jitter exponential backoff.
+    :param attempt: retry number, starting at 0
+    :param base: delay of the first retry
+    :param cap: maximum delay
+    :return: seconds to sleep
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Async token bucket rate limiter.
+        :param rate: tokens added per second
+        :param capacity: burst size, defaults to one second worth of tokens
+        """
+        self.rate: float = rate
+        self.capacity: float = capacity if capacity is not None else max(1.0, rate)
+        self.tokens: float = self.capacity
+        self.updated: float = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1):
+        """
+        Wait until `tokens` are available and take them. Waiters are served in order.
+        """
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Empty the bucket so that nothing is handed out for `seconds`, ie after the remote end
+        told us we are over its limit.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class ApiKeyPool:
+    def __init__(self, keys: list, rate: float, capacity: float = None):
+        """
+        Rotate requests over several API keys, each with its own rate limit.
+        :param keys: api keys, an empty list means a single keyless client
+        :param rate: requests per second allowed per key
+        :param capacity: burst size per key
+        """
+        self.keys: list = list(keys) or [None]
+        self.buckets: dict = {key: TokenBucket(rate, capacity) for key in self.keys}
+        self._cycle = itertools.cycle(self.keys)
+
+    async def acquire(self):
+        """
+        :return: the next key, once its bucket allows another request
+        """
+        key = next(self._cycle)
+        await self.buckets[key].acquire()
+        return key
+
+    def pause(self, key, seconds: float):
+        self.buckets[key].pause(seconds)
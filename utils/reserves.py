@@ -0,0 +1,215 @@
+import os
+import sqlite3
+import time
+
+from eth_typing import ChecksumAddress
+from eth_utils import to_checksum_address
+
+from utils.helpers import cache_dir
+from utils.multicall import Multicall
+
+GET_PAIR_SELECTOR = bytes.fromhex('e6a43905')
+GET_RESERVES_SELECTOR = bytes.fromhex('0902f1ac')
+ZERO_ADDRESS = '0x' + '00' * 20
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    network TEXT NOT NULL,
+    factory TEXT NOT NULL,
+    token0 TEXT NOT NULL,
+    token1 TEXT NOT NULL,
+    pair TEXT,
+    checked REAL NOT NULL,
+    PRIMARY KEY (network, factory, token0, token1)
+);
+CREATE TABLE IF NOT EXISTS synced (
+    network TEXT NOT NULL,
+    factory TEXT NOT NULL,
+    last_block INTEGER NOT NULL,
+    PRIMARY KEY (network, factory)
+);
+"""
+
+
+def sort_tokens(token_a: str, token_b: str) -> tuple[str, str]:
+    """
+    :return: the two tokens in the order of the pair's token0, token1
+    """
+    token_a, token_b = token_a.lower(), token_b.lower()
+    return (token_a, token_b) if token_a < token_b else (token_b, token_a)
+
+
+def get_amount_out(amount_in: int, reserve_in: int, reserve_out: int, fee_bps: int = 30) -> int:
+    """
+    UniswapV2Library.getAmountOut with the fee in basis points (30 for uniswap and mdex, 25 for pancake)
+    :return: what a swap of `amount_in` gets out of the pair, 0 without liquidity
+    """
+    if amount_in <= 0 or reserve_in <= 0 or reserve_out <= 0:
+        return 0
+    amount_in_with_fee = amount_in * (10000 - fee_bps)
+    return amount_in_with_fee * reserve_out // (reserve_in * 10000 + amount_in_with_fee)
+
+
+class PairCache:
+    def __init__(self, path: str = None, recheck: float = 24 * 3600):
+        """
+        On disk map of (factory, token pair) to pair address. Pairs never move, so found ones are kept
+        for good, pairs that did not exist are asked again after `recheck` seconds.
+        :param path: sqlite file, defaults to pairs.sqlite in the cache directory
+        """
+        self.path = path or os.path.join(cache_dir(), 'pairs.sqlite')
+        self.recheck = recheck
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def get(self, network: str, factory: str, token0: str, token1: str) -> (str, None, False):
+        """
+        :return: the pair address, None if the pair does not exist, False if it is not cached
+        """
+        row = self.db.execute('SELECT pair, checked FROM pairs WHERE network = ? AND factory = ? AND token0 = ? '
+                              'AND token1 = ?', (network, factory.lower(), token0, token1)).fetchone()
+        if row is None or (row[0] is None and time.time() - row[1] >= self.recheck):
+            return False
+        return row[0]
+
+    def update(self, network: str, factory: str, pairs: dict[tuple[str, str], (str, None)]):
+        """
+        :param pairs: {(token0, token1): pair address or None}
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)',
+                                [(network, factory.lower(), token0, token1, pair, now)
+                                 for (token0, token1), pair in pairs.items()])
+
+    def last_synced(self, network: str, factory: str) -> (int, None):
+        """
+        :return: last block the PairCreated events of the factory were indexed up to, None if never
+        """
+        row = self.db.execute('SELECT last_block FROM synced WHERE network = ? AND factory = ?',
+                              (network, factory.lower())).fetchone()
+        return row[0] if row else None
+
+    def add_created(self, network: str, factory: str, pairs: list[tuple[str, str, str]], last_block: int):
+        """
+        Store pairs from PairCreated events and how far the events were indexed, in one transaction.
+        :param pairs: [(token0, token1, pair), ...] lowercase
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)',
+                                [(network, factory.lower(), token0, token1, pair, now)
+                                 for token0, token1, pair in pairs])
+            self.db.execute('INSERT OR REPLACE INTO synced VALUES (?, ?, ?)', (network, factory.lower(), last_block))
+
+    def existing(self, network: str, factory: str) -> list[tuple[str, str, str]]:
+        """
+        :return: [(token0, token1, pair), ...] of every known pair of the factory
+        """
+        return self.db.execute('SELECT token0, token1, pair FROM pairs WHERE network = ? AND factory = ? '
+                               'AND pair IS NOT NULL', (network, factory.lower())).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+class ReservesEngine:
+    def __init__(self, multicall: Multicall, network: str, factory: (str, ChecksumAddress), fee_bps: int = 30,
+                 pair_cache: PairCache = None):
+        """
+        Quotes swaps through uniswap v2 style pairs off chain: pair addresses come from the PairCache
+        or one multicall of factory.getPair for the missing ones, reserves from one multicall of
+        getReserves pinned to a block, and the output is computed locally. Thousands of quotes take a
+        few eth_calls instead of one getAmountsOut each.
+        :param multicall: batches the reads
+        :param network: key of the pair cache
+        :param factory: pair factory
+        :param fee_bps: swap fee of the pairs in basis points
+        :param pair_cache: defaults to a PairCache in the cache directory
+        """
+        self.multicall = multicall
+        self.network = network
+        self.factory: ChecksumAddress = to_checksum_address(factory)
+        self.fee_bps = fee_bps
+        self.pair_cache = pair_cache or PairCache()
+        # reserves of the last fetched block, {pair: (reserve0, reserve1)}
+        self.block: (int, None) = None
+        self._reserves: dict[str, tuple[int, int]] = {}
+
+    async def pairs(self, token_pairs: list[tuple[str, str]]) -> dict[tuple[str, str], (str, None)]:
+        """
+        :param token_pairs: [(token_a, token_b), ...] in any order
+        :return: {(token0, token1): pair address, None where there is no pair}
+        """
+        found = {}
+        missing = []
+        for token_a, token_b in token_pairs:
+            key = sort_tokens(token_a, token_b)
+            if key in found:
+                continue
+            pair = self.pair_cache.get(self.network, self.factory, *key)
+            if pair is False:
+                found[key] = None
+                missing.append(key)
+            else:
+                found[key] = pair
+        if missing:
+            calls = [(self.factory, GET_PAIR_SELECTOR + bytes(12) + bytes.fromhex(token0[2:]) + bytes(12) +
+                      bytes.fromhex(token1[2:])) for token0, token1 in missing]
+            fetched = {}
+            for key, (success, data) in zip(missing, await self.multicall.aggregate3(calls)):
+                if not success or len(data) < 32:
+                    # failed call, not a missing pair: not cached
+                    continue
+                pair = '0x' + data[12:32].hex()
+                fetched[key] = None if pair == ZERO_ADDRESS else pair
+            self.pair_cache.update(self.network, self.factory, fetched)
+            found.update(fetched)
+        return found
+
+    async def reserves(self, pairs: list[str], block: int = None) -> dict[str, tuple[int, int]]:
+        """
+        :param pairs: pair addresses
+        :param block: block to read at, defaults to the current one. Reserves already read at that
+        block are not asked again
+        :return: {pair: (reserve0, reserve1)} for the pairs that answered
+        """
+        if block is None:
+            block = await self.multicall.rpc.block_number()
+        if block != self.block:
+            self.block = block
+            self._reserves = {}
+        # a concurrent call at a newer block may replace self._reserves meanwhile
+        known = self._reserves
+        missing = list({pair for pair in pairs if pair not in known})
+        if missing:
+            results = await self.multicall.aggregate3([(pair, GET_RESERVES_SELECTOR) for pair in missing], block)
+            for pair, (success, data) in zip(missing, results):
+                if success and len(data) >= 64:
+                    known[pair] = (int.from_bytes(data[:32], 'big'), int.from_bytes(data[32:64], 'big'))
+        return {pair: known[pair] for pair in pairs if pair in known}
+
+    async def pair_reserves(self, swaps: list[tuple[str, str]], block: int = None) -> list[tuple[int, int]]:
+        """
+        :param swaps: [(token in, token out), ...] through the direct pair
+        :param block: see reserves
+        :return: (reserve in, reserve out) of each swap, (0, 0) where there is no pair
+        """
+        pairs = await self.pairs(swaps)
+        reserves = await self.reserves([pair for pair in set(pairs.values()) if pair is not None], block)
+        oriented = []
+        for token_in, token_out in swaps:
+            key = sort_tokens(token_in, token_out)
+            pair_reserves = reserves.get(pairs.get(key), (0, 0))
+            oriented.append(pair_reserves if token_in.lower() == key[0] else pair_reserves[::-1])
+        return oriented
+
+    async def amounts_out(self, swaps: list[tuple[int, str, str]], block: int = None) -> list[int]:
+        """
+        :param swaps: [(amount in, token in, token out), ...] through the direct pair
+        :param block: see reserves
+        :return: amount out of each swap, 0 where there is no pair or no liquidity
+        """
+        reserves = await self.pair_reserves([(token_in, token_out) for _, token_in, token_out in swaps], block)
+        return [get_amount_out(amount_in, reserve_in, reserve_out, self.fee_bps)
+                for (amount_in, _, _), (reserve_in, reserve_out) in zip(swaps, reserves)]
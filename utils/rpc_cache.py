@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.helpers import cache_dir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+# the block parameter is the last one of these
+STATE_METHODS = {'eth_getBalance', 'eth_getCode', 'eth_getTransactionCount', 'eth_getStorageAt', 'eth_call',
+                 'eth_getProof'}
+# and the first one of these
+BLOCK_NUMBER_METHODS = {'eth_getBlockByNumber', 'eth_getBlockTransactionCountByNumber',
+                        'eth_getUncleCountByBlockNumber', 'eth_getTransactionByBlockNumberAndIndex',
+                        'eth_getUncleByBlockNumberAndIndex'}
+# a hash pins the content, as long as there is any
+BLOCK_HASH_METHODS = {'eth_getBlockByHash', 'eth_getBlockTransactionCountByHash', 'eth_getUncleCountByBlockHash',
+                      'eth_getTransactionByBlockHashAndIndex', 'eth_getUncleByBlockHashAndIndex'}
+# immutable once mined deep enough
+TRANSACTION_METHODS = {'eth_getTransactionByHash', 'eth_getTransactionReceipt'}
+STATIC_METHODS = {'net_version'}
+
+
+def block_number(block) -> (int, None):
+    """
+    :return: the number of a block parameter, None for tags like `latest`
+    """
+    if isinstance(block, int):
+        return block
+    if isinstance(block, str) and block.startswith('0x'):
+        return int(block, 16)
+    if isinstance(block, dict) and 'blockNumber' in block:
+        return block_number(block['blockNumber'])
+    return None
+
+
+class RpcCache:
+    def __init__(self, path: str = None, max_bytes: int = 256 * 1024 * 1024):
+        """
+        On disk LRU store of json-rpc results.
+        :param path: sqlite file, defaults to rpc.sqlite in the cache directory
+        :param max_bytes: least recently used entries are dropped past this much stored json
+        """
+        self.path = path or os.path.join(cache_dir(), 'rpc.sqlite')
+        self.max_bytes = max_bytes
+        # web3 is called from worker threads too
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        size, used = self.db.execute('SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM entries').fetchone()
+        self.size: int = size
+        self._clock: int = used
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: str):
+        """
+        :return: the cached result, None on a miss
+        """
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            with self.db:
+                self.db.execute('UPDATE entries SET used = ? WHERE key = ?', (self._clock, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value):
+        data = json.dumps(value, separators=(',', ':'))
+        with self.lock:
+            self._clock += 1
+            with self.db:
+                old = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                (key, data, len(data), self._clock))
+                self.size += len(data) - (old[0] if old else 0)
+                if self.size > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        # down to 90% so that eviction does not run on every insert
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = self.db.execute('SELECT key, size FROM entries ORDER BY used LIMIT 256').fetchall()
+            if not rows:
+                self.size = 0
+                return
+            self.db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in rows])
+            self.size -= sum(size for _, size in rows)
+
+    def close(self):
+        self.db.close()
+
+
+def construct_rpc_cache_middleware(cache: RpcCache, confirmations: int = 64, head_ttl: float = 60.0,
+                                   chain_id: int = None):
+    """
+    web3 middleware that serves immutable json-rpc results from `cache`: blocks, transactions,
+    receipts and state reads pinned to a block at least `confirmations` deep, reads by block hash,
+    and logs over such ranges. Anything at `latest`/`pending`, or too recent to be final, goes to
+    the node untouched. Entries are keyed by chain id, method and params. Inject it at layer 0 so it
+    sees the raw responses.
+    :param cache: store
+    :param confirmations: blocks behind the head before a block is treated as final
+    :param head_ttl: seconds between eth_blockNumber calls used to tell how deep a block is
+    :param chain_id: known chain id, otherwise it is asked once
+    """
+
+    def rpc_cache_middleware(make_request, w3):
+        state = {'chain_id': None if chain_id is None else hex(chain_id), 'head': None, 'head_time': 0.0}
+
+        def get_chain_id() -> str:
+            if state['chain_id'] is None:
+                state['chain_id'] = make_request('eth_chainId', [])['result']
+            return state['chain_id']
+
+        def is_final(number: (int, None)) -> bool:
+            if number is None:
+                return False
+            if state['head'] is None or time.monotonic() - state['head_time'] >= head_ttl:
+                state['head'] = int(make_request('eth_blockNumber', [])['result'], 16)
+                state['head_time'] = time.monotonic()
+            return number <= state['head'] - confirmations
+
+        def cacheable_request(method: str, params) -> bool:
+            if method in STATIC_METHODS or method in BLOCK_HASH_METHODS:
+                return True
+            if method in STATE_METHODS:
+                block = params[-1] if params else None
+                return (isinstance(block, dict) and 'blockHash' in block) or is_final(block_number(block))
+            if method in BLOCK_NUMBER_METHODS:
+                return bool(params) and is_final(block_number(params[0]))
+            if method == 'eth_getLogs':
+                log_filter = params[0] if params else {}
+                if 'blockHash' in log_filter:
+                    return True
+                return block_number(log_filter.get('fromBlock')) is not None and \
+                    is_final(block_number(log_filter.get('toBlock')))
+            return method in TRANSACTION_METHODS
+
+        def cacheable_result(method: str, result) -> bool:
+            if result is None:
+                return False
+            if method in TRANSACTION_METHODS:
+                return is_final(block_number(result.get('blockNumber')))
+            return True
+
+        def middleware(method, params):
+            if method == 'eth_chainId':
+                return {'jsonrpc': '2.0', 'id': 0, 'result': get_chain_id()}
+            if not cacheable_request(method, params):
+                return make_request(method, params)
+            key = f'{get_chain_id()}:{method}:{json.dumps(params, sort_keys=True, separators=(",", ":"))}'
+            result = cache.get(key)
+            if result is not None:
+                return {'jsonrpc': '2.0', 'id': 0, 'result': result}
+            response = make_request(method, params)
+            if 'error' not in response and cacheable_result(method, response.get('result')):
+                cache.put(key, response['result'])
+            return response
+
+        return middleware
+
+    return rpc_cache_middleware
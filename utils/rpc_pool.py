@@ -0,0 +1,179 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+import web3
+from web3.providers.base import BaseProvider
+
+# never sent twice, or tied to the node that created them
+UNHEDGED_METHODS = {'eth_sendRawTransaction', 'eth_sendTransaction', 'eth_sign', 'eth_signTransaction',
+                    'eth_signTypedData', 'personal_sign', 'personal_sendTransaction'}
+STICKY_METHODS = {'eth_newFilter', 'eth_newBlockFilter', 'eth_newPendingTransactionFilter', 'eth_getFilterChanges',
+                  'eth_getFilterLogs', 'eth_uninstallFilter'}
+# what counts against an endpoint, json-rpc error responses do not
+TRANSPORT_ERRORS = (requests.RequestException, OSError, ValueError)
+
+
+class Endpoint:
+    def __init__(self, url: str, timeout: float = 30, alpha: float = 0.2):
+        """
+        One node of a RpcPool with its health.
+        :param alpha: weight of the latest sample in the moving averages
+        """
+        self.url = url
+        self.provider = web3.HTTPProvider(url, request_kwargs={'timeout': timeout}, session=requests.Session())
+        self.alpha = alpha
+        # seconds, optimistic until measured
+        self.latency: float = 0.1
+        # moving average of failed requests, 0 to 1
+        self.error_rate: float = 0.0
+        self.failures: int = 0
+        self.ejected_until: float = 0.0
+        self.ejections: int = 0
+        self.requests: int = 0
+        self.errors: int = 0
+
+    @property
+    def admitted(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def score(self) -> float:
+        """
+        :return: lower is better, latency inflated by the error rate
+        """
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def record(self, seconds: float, ok: bool):
+        self.requests += 1
+        if ok:
+            # failures are often timeouts, they do not say how fast the node answers
+            self.latency += self.alpha * (seconds - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.failures = 0
+            self.ejections = 0
+        else:
+            self.errors += 1
+            self.failures += 1
+
+
+class RpcPool(BaseProvider):
+    def __init__(self, urls: list[str], timeout: float = 30, hedge_after: float = None, max_failures: int = 3,
+                 max_error_rate: float = 0.5, cooldown: float = 30.0, max_cooldown: float = 600.0):
+        """
+        web3 provider spreading requests over several endpoints of the same chain. Requests favour the
+        endpoints with the best moving averages of latency and error rate. Reads still unanswered after
+        `hedge_after` are sent to a second endpoint as well and the first answer wins. Transport errors
+        fail over to the next endpoint, endpoints that keep failing are ejected for a cooldown that
+        doubles each time, then re-admitted on probation.
+        :param urls: http endpoints
+        :param timeout: per request
+        :param hedge_after: seconds before a read is hedged, None for three times the endpoint's
+        average latency (between 50ms and 2s)
+        :param max_failures: consecutive failures that eject an endpoint
+        :param max_error_rate: error rate that ejects an endpoint
+        :param cooldown: first ejection, in seconds
+        :param max_cooldown: longest ejection
+        """
+        super().__init__()
+        self.endpoints: list[Endpoint] = [Endpoint(url, timeout) for url in urls]
+        self.hedge_after = hedge_after
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hedged: int = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.endpoints), thread_name_prefix='rpc-pool')
+
+    def __str__(self):
+        return f'RpcPool({", ".join(endpoint.url for endpoint in self.endpoints)})'
+
+    def ranked(self) -> list[Endpoint]:
+        """
+        :return: endpoints to try in order: a random admitted one weighted by 1 / score ** 2, so that
+        similar endpoints share the load and slow ones still get probed now and then, then the other
+        admitted ones by score, then the ejected ones by time left
+        """
+        with self._lock:
+            admitted = [endpoint for endpoint in self.endpoints if endpoint.admitted]
+            ejected = sorted((endpoint for endpoint in self.endpoints if not endpoint.admitted),
+                             key=lambda endpoint: endpoint.ejected_until)
+            if len(admitted) > 1:
+                first = random.choices(admitted, weights=[1 / endpoint.score() ** 2 for endpoint in admitted])[0]
+                admitted.remove(first)
+                return [first] + sorted(admitted, key=Endpoint.score) + ejected
+            return admitted + ejected
+
+    def _record(self, endpoint: Endpoint, seconds: float, ok: bool):
+        with self._lock:
+            endpoint.record(seconds, ok)
+            if not ok and (endpoint.failures >= self.max_failures or endpoint.error_rate >= self.max_error_rate):
+                endpoint.ejected_until = time.monotonic() + min(self.max_cooldown,
+                                                                self.cooldown * 2 ** endpoint.ejections)
+                endpoint.ejections += 1
+                # on probation once back
+                endpoint.failures = self.max_failures - 1
+
+    def _call(self, endpoint: Endpoint, method, params):
+        start = time.monotonic()
+        try:
+            response = endpoint.provider.make_request(method, params)
+        except TRANSPORT_ERRORS:
+            self._record(endpoint, time.monotonic() - start, False)
+            raise
+        self._record(endpoint, time.monotonic() - start, True)
+        return response
+
+    def _failover(self, endpoints: list[Endpoint], method, params):
+        err = None
+        for endpoint in endpoints:
+            try:
+                return self._call(endpoint, method, params)
+            except TRANSPORT_ERRORS as e:
+                err = e
+        raise err
+
+    def _hedged(self, endpoints: list[Endpoint], method, params):
+        primary, others = endpoints[0], endpoints[1:]
+        delay = self.hedge_after if self.hedge_after is not None else min(2.0, max(0.05, 3 * primary.latency))
+        first = self._executor.submit(self._call, primary, method, params)
+        done, _ = wait([first], timeout=delay)
+        if done and first.exception() is None:
+            return first.result()
+        if not others:
+            return first.result()
+        if not done:
+            self.hedged += 1
+        # the slow or failed primary races the rest of the pool
+        pending = {first, self._executor.submit(self._failover, others, method, params)}
+        err = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                err = future.exception()
+        raise err
+
+    def make_request(self, method, params):
+        if method in STICKY_METHODS:
+            return self._call(self.endpoints[0], method, params)
+        endpoints = self.ranked()
+        if method in UNHEDGED_METHODS or len(endpoints) == 1:
+            return self._failover(endpoints, method, params)
+        return self._hedged(endpoints, method, params)
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return any(endpoint.provider.is_connected() for endpoint in self.endpoints)
+
+    def summary(self) -> str:
+        lines = []
+        for endpoint in self.endpoints:
+            state = 'up' if endpoint.admitted else f'ejected {endpoint.ejected_until - time.monotonic():.0f}s'
+            lines.append(f'{endpoint.url}: {state}, {endpoint.latency * 1000:.0f}ms, '
+                         f'{endpoint.error_rate:.0%} errors, {endpoint.requests} requests')
+        lines.append(f'{self.hedged} requests hedged')
+        return '\n'.join(lines)
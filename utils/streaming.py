@@ -0,0 +1,45 @@
+import collections
+import concurrent.futures
+from typing import Callable, Iterable, Iterator
+
+
+def read_chunks(file: str, chunk_size: int = 1024) -> Iterator[list[str]]:
+    """
+    Lazily read a text file as lists of stripped, non empty lines, so huge input
+    files never have to be loaded into memory at once.
+    :param file: path to the input file
+    :param chunk_size: lines per chunk
+    :return: generator of line lists
+    """
+    chunk = []
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.strip('\r\n')
+            if line:
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+def bounded_map(executor: concurrent.futures.Executor, fn: Callable, iterable: Iterable,
+                max_pending: int) -> Iterator:
+    """
+    Like executor.map, but only keeps `max_pending` tasks in flight, so the input
+    iterable is consumed lazily and memory stays bounded. Results are yielded in
+    submission order.
+    :param executor: thread or process pool
+    :param fn: function to apply, must be picklable for process pools
+    :param iterable: work items
+    :param max_pending: maximum number of submitted but not yet yielded tasks
+    :return: generator of results
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,125 @@
+import codecs
+import json
+
+from eth_utils import to_checksum_address
+
+
+class TokenMeta:
+    __slots__ = ('contract_address', 'name', 'symbol', 'decimals')
+
+    def __init__(self, contract_address: str, name: str = None, symbol: str = None, decimals: (str, int) = None):
+        """
+        Token metadata, one per distinct contract of an account.
+        :param contract_address: checksummed contract address
+        """
+        self.contract_address = contract_address
+        self.name = name
+        self.symbol = symbol
+        self.decimals = decimals
+
+
+class TokenTxParser:
+    def __init__(self):
+        """
+        Incremental parser for indexer `tokentx` responses. Feed it the body as it arrives, every
+        transfer is folded into a {contract: TokenMeta} map as soon as it is complete and then
+        dropped, so memory is bound by the number of distinct tokens instead of transfers.
+        The `status`/`message` head is parsed as well; a response whose `result` is not an array
+        (rate limits, errors) is buffered and decoded whole by close().
+        """
+        self.tokens: dict[str, TokenMeta] = {}
+        self.last_block: (int, None) = None
+        self.transfers: int = 0
+        # True once the closing bracket of the result array was seen
+        self.complete: bool = False
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._head = ''
+        self._tail = ''
+        self._state = 'head'
+
+    def _add(self, tx: dict):
+        self.transfers += 1
+        contract = tx.get('contractAddress')
+        if contract:
+            key = contract.lower()
+            if key not in self.tokens:
+                self.tokens[key] = TokenMeta(to_checksum_address(key), tx.get('tokenName'), tx.get('tokenSymbol'),
+                                             tx.get('tokenDecimal'))
+        block = tx.get('blockNumber')
+        if block:
+            block = int(block)
+            if self.last_block is None or block > self.last_block:
+                self.last_block = block
+
+    def _parse_head(self):
+        key = self._buf.find('"result"')
+        if key < 0:
+            return
+        pos = key + len('"result"')
+        while pos < len(self._buf) and self._buf[pos] in ' \t\r\n:':
+            pos += 1
+        if pos == len(self._buf):
+            return
+        if self._buf[pos] != '[':
+            self._state = 'raw'
+            return
+        self._head = self._buf[:key]
+        self._buf = self._buf[pos + 1:]
+        self._state = 'items'
+
+    def _parse_items(self):
+        pos, end = 0, len(self._buf)
+        while True:
+            while pos < end and self._buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == end:
+                break
+            if self._buf[pos] == ']':
+                self.complete = True
+                self._tail = self._buf[pos + 1:]
+                self._state = 'tail'
+                pos = end
+                break
+            try:
+                tx, pos = self._decoder.raw_decode(self._buf, pos)
+            except json.JSONDecodeError:
+                # transfer not complete yet
+                break
+            if isinstance(tx, dict):
+                self._add(tx)
+        self._buf = self._buf[pos:]
+
+    def feed(self, chunk: bytes):
+        self._feed_text(self._text.decode(chunk))
+
+    def _feed_text(self, text: str):
+        if self._state == 'tail':
+            self._tail += text
+            return
+        self._buf += text
+        if self._state == 'head':
+            self._parse_head()
+        if self._state == 'items':
+            self._parse_items()
+
+    def close(self) -> dict:
+        """
+        :return: the response without its result array, or the whole response if the result was not
+        an array. `tokens` and `last_block` hold the parsed transfers.
+        :raises ValueError: if the body is not json
+        """
+        self._feed_text(self._text.decode(b'', final=True))
+        if self._state == 'raw' or self._state == 'head':
+            ret = json.loads(self._buf)
+            if isinstance(ret, dict) and isinstance(ret.get('result'), list):
+                for tx in ret['result']:
+                    if isinstance(tx, dict):
+                        self._add(tx)
+                self.complete = True
+            return ret
+        if not self.complete:
+            raise ValueError('truncated tokentx response')
+        # stitch the head and tail back together around an empty result
+        return json.loads(self._head + '"result":[]' + self._tail)
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+from eth_utils import to_checksum_address
+
+from utils.helpers import cache_dir
+from utils.tokentx import TokenMeta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    network TEXT NOT NULL,
+    address TEXT NOT NULL,
+    last_block INTEGER NOT NULL,
+    PRIMARY KEY (network, address)
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    network TEXT NOT NULL,
+    address TEXT NOT NULL,
+    contract TEXT NOT NULL,
+    name TEXT,
+    symbol TEXT,
+    decimals TEXT,
+    PRIMARY KEY (network, address, contract)
+);
+"""
+
+
+class TokenTxCache:
+    def __init__(self, path: str = None):
+        """
+        Local cache of indexer `tokentx` history. For every (network, address) it keeps the token
+        contracts seen so far and the highest block fetched, so rescans only ask the indexer for
+        transfers after that block.
+        :param path: sqlite file, defaults to tokentx.sqlite in the cache directory
+        """
+        self.path = path or os.path.join(cache_dir(), 'tokentx.sqlite')
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def last_block(self, network: str, address: str) -> (int, None):
+        """
+        :return: highest block already fetched for this address, None if it was never fetched
+        """
+        row = self.db.execute('SELECT last_block FROM accounts WHERE network = ? AND address = ?',
+                              (network, address.lower())).fetchone()
+        return row[0] if row else None
+
+    def tokens(self, network: str, address: str) -> list[TokenMeta]:
+        """
+        :return: the cached token contracts of an address
+        """
+        rows = self.db.execute('SELECT contract, name, symbol, decimals FROM tokens WHERE network = ? AND address = ?',
+                               (network, address.lower()))
+        return [TokenMeta(to_checksum_address(contract), name, symbol, decimals)
+                for contract, name, symbol, decimals in rows]
+
+    def update(self, network: str, address: str, tokens: list[TokenMeta], last_block: int = None):
+        """
+        Merge newly fetched tokens into the cache.
+        :param tokens: distinct tokens seen in the fetched transfers
+        :param last_block: highest block covered by this fetch, None leaves it unchanged
+        """
+        address = address.lower()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?, ?, ?)',
+                                [(network, address, token.contract_address.lower(), token.name, token.symbol,
+                                  token.decimals) for token in tokens])
+            if last_block is not None:
+                self.db.execute('INSERT INTO accounts VALUES (?, ?, ?) ON CONFLICT (network, address) '
+                                'DO UPDATE SET last_block = max(last_block, excluded.last_block)',
+                                (network, address, last_block))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,85 @@
+import numpy as np
+
+# fractions of the balance the exit ladder is valued at
+LADDER = (0.01, 0.1, 1.0)
+
+
+def amounts_out(amount_in: np.ndarray, reserve_in: np.ndarray, reserve_out: np.ndarray, fee_bps: int) -> np.ndarray:
+    """
+    reserves.get_amount_out over float64 arrays. uint256 amounts and uint112 reserves overflow int64
+    but fit a float64 many times over, and the 1e-16 relative rounding does not matter for a valuation
+    :return: amounts out, 0 where there is no liquidity
+    """
+    live = (amount_in > 0) & (reserve_in > 0) & (reserve_out > 0)
+    amount_in_with_fee = amount_in * (10000 - fee_bps)
+    denominator = np.where(live, reserve_in * 10000 + amount_in_with_fee, 1.0)
+    return np.where(live, amount_in_with_fee * reserve_out / denominator, 0.0)
+
+
+class Valuation:
+    def __init__(self, value: np.ndarray, quote_index: np.ndarray, spot: np.ndarray, price_impact: np.ndarray,
+                 ladder: np.ndarray):
+        """
+        USD valuation of n token balances, see value_portfolio
+        :param value: (n,) value of selling the whole balance through the best quote token
+        :param quote_index: (n,) index of that quote token, meaningless where value is 0
+        :param spot: (n,) value at the pair's marginal price, without fee or price impact
+        :param price_impact: (n,) share of the spot value lost to fee and slippage, 0 to 1
+        :param ladder: (n, len(LADDER)) best value of selling each LADDER fraction of the balance
+        """
+        self.value = value
+        self.quote_index = quote_index
+        self.spot = spot
+        self.price_impact = price_impact
+        self.ladder = ladder
+
+    def mask(self, threshold: float = 0) -> np.ndarray:
+        """
+        :return: (n,) bool, balances worth something and more than `threshold`
+        """
+        return (self.value > 0) & (self.value > threshold)
+
+    def row(self, i: int) -> dict:
+        """
+        :return: the valuation of balance i as report fields
+        """
+        return {'quote': float(self.value[i]),
+                'price_impact': float(self.price_impact[i]),
+                'ladder': {f'{fraction:.0%}': float(value) for fraction, value in zip(LADDER, self.ladder[i])}}
+
+
+def value_portfolio(amounts: list[int], reserves: list[list[tuple[int, int]]], quote_decimals: list[int],
+                    quote_prices: list[float], fee_bps: int = 30) -> Valuation:
+    """
+    Value every balance against every quote token in one pass over (balance, quote token) arrays.
+    :param amounts: n raw balances
+    :param reserves: n rows of q (reserve in, reserve out), the pair of the balance's token with each
+    quote token, (0, 0) where there is none
+    :param quote_decimals: q decimals of the quote tokens
+    :param quote_prices: q USD prices of the quote tokens
+    :param fee_bps: swap fee of the pairs
+    """
+    n, q = len(amounts), len(quote_decimals)
+    if n == 0:
+        return Valuation(np.zeros(0), np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros((0, len(LADDER))))
+    # python ints to float64 one by one, numpy would refuse the ones past int64
+    amount = np.fromiter(amounts, dtype=float, count=n)[:, None]
+    pair_reserves = np.array(reserves, dtype=float).reshape(n, q, 2)
+    reserve_in, reserve_out = pair_reserves[..., 0], pair_reserves[..., 1]
+    # USD per raw unit of each quote token
+    scale = np.asarray(quote_prices, dtype=float) / 10.0 ** np.asarray(quote_decimals, dtype=float)
+
+    values = amounts_out(amount, reserve_in, reserve_out, fee_bps) * scale
+    quote_index = values.argmax(axis=1)
+    rows = np.arange(n)
+    value = values[rows, quote_index]
+
+    best_in, best_out = reserve_in[rows, quote_index], reserve_out[rows, quote_index]
+    spot = np.where(best_in > 0, amount[:, 0] * best_out / np.where(best_in > 0, best_in, 1.0), 0.0)
+    spot *= scale[quote_index]
+    price_impact = np.where(spot > 0, 1 - value / np.where(spot > 0, spot, 1.0), 0.0)
+
+    ladder = np.empty((n, len(LADDER)))
+    for step, fraction in enumerate(LADDER):
+        ladder[:, step] = (amounts_out(amount * fraction, reserve_in, reserve_out, fee_bps) * scale).max(axis=1)
+    return Valuation(value, quote_index, spot, price_impact, ladder)
@@ -10,10 +10,13 @@ import time
 import dotenv
 import requests
 import web3
-from web3.middleware import geth_poa_middleware
 
 import libs.abi_lib
+from exceptions.errors import PriceUnavailable
 from libs import style
+from utils import init_w3
+from utils.health import ConnectionHealth
+from utils.price_oracle import NativePriceOracle
 
 # Hacky fix because I was using the beta web3 which has clumsy backward compatibility issues
 try:
@@ -41,7 +44,9 @@ class ZeroX:
         self.network = network
         self.endpoint = None
         self.abi = None
-        self.w3 = self.setup_w3()
+        self.health: (ConnectionHealth, None) = None
+        self.setup_w3()
+        self.oracle = NativePriceOracle(network)
         self.exchange_router = '0xDef1C0ded9bec7F1a1670819833240f027b25EfF'
         self.no_prompt = no_prompt
 
@@ -65,36 +70,33 @@ class ZeroX:
             del f
             return priv, addr
 
+    @property
+    def w3(self) -> web3.Web3:
+        return self.health.w3
+
     def setup_w3(self, ):
-        w3_endpoint = os.environ.get(f'{self.network}_http_endpoint')
-        self.w3 = web3.Web3(web3.HTTPProvider(w3_endpoint))
-        try:
-            conn = self.w3.isConnected()
-        except AttributeError:
-            conn = self.w3.is_connected()
-        finally:
-            if conn:
-                self.print.good(f"Connected to chain: {self.w3.eth.chain_id}")
-            else:
-                self.print.error(f'Web3 could not connect to remote endpoint: {w3_endpoint} , exiting!!')
-                exit(1)
+        w3 = init_w3.setup_w3(self.network)
+        if not w3:
+            self.print.error(f'Web3 could not connect to remote endpoint: '
+                             f'{os.environ.get(f"{self.network}_http_endpoint")} , exiting!!')
+            exit(1)
         if self.network == 'ethereum':
             self.endpoint = 'https://api.0x.org/'
             self.abi = libs.abi_lib.EIP20_ABI
         elif self.network == 'polygon':
             self.endpoint = 'https://polygon.api.0x.org/'
             self.abi = libs.abi_lib.EIP20_ABI
-            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
         elif self.network == 'bsc':
             self.abi = libs.abi_lib.BEP_ABI
-            self.w3.middleware_onion.inject(geth_poa_middleware, layer=0)
             self.endpoint = 'https://bsc.api.0x.org/'
             self.print.warning('Connected to BSC, which has not been tested very well yet.')
         elif self.network == 'arbitrum':
             self.abi = libs.abi_lib.EIP20_ABI
             self.endpoint = 'https://arbitrum.api.0x.org/'
+        self.health = ConnectionHealth(w3, printer=self.print)
 
-        self.print.good(f'Web3 connected to chain: {self.w3.eth.chain_id}')
+        self.print.good(f'Web3 connected to chain: {self.w3.chain_metadata["chain_id"]} '
+                        f'({self.w3.chain_metadata["client_version"]})')
         return self.w3
 
     def balance_check(self, contract_address: str = None):
@@ -265,7 +267,14 @@ if __name__ == '__main__':
                     f'Wallet: {args.json_wallet_file}')
     if args.native_balance:
         raw, human = api.balance_check(contract_address=None)
-        api.print.good(f'Balance: {human}, Raw: {raw}')
+        try:
+            native = api.oracle.price(api.w3)
+        except PriceUnavailable as err:
+            api.print.warning(err)
+            api.print.good(f'Balance: {human}, Raw: {raw}')
+        else:
+            api.print.good(f'Balance: {human}, Raw: {raw}, ~${human * native.price:,.2f} '
+                           f'(price {native.age:.0f}s old, {native.source})')
     if args.balance_check and type(args.balance_check) is not bool:
         raw, human = api.balance_check(args.balance_check)
         api.print.good(f'Balance: {human}, Raw: {raw}')